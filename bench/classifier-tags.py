@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Check the plan of the query for the highest tag of each package and
+compare its run time with the correlated max(version) subquery it
+replaced.
+
+usage: bench/classifier-tags.py [--team NAME] [--repeat N]
+
+Exits with status 1 if the plan contains a SubPlan, that is if
+PostgreSQL evaluates a subquery once per tag again.
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pet.models import *
+from pet.classifier import Classifier
+
+import argparse
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.orm
+import time
+
+def correlated_max_version(session, named_trees):
+  """the query used before DISTINCT ON"""
+  Tags = sqlalchemy.orm.aliased(NamedTree)
+  Reference = sqlalchemy.orm.aliased(NamedTree)
+  max_version = session.query(sqlalchemy.func.max(Reference.version)) \
+      .filter(Reference.type == 'tag') \
+      .filter(Reference.package_id == Tags.package_id) \
+      .correlate(Tags) \
+      .as_scalar()
+  return session.query(Tags) \
+      .filter(Tags.type == 'tag') \
+      .filter(Tags.version == max_version) \
+      .order_by(Tags.package_id, Tags.version.desc()) \
+      .filter(Tags.package_id.in_(named_trees.from_self(NamedTree.package_id).subquery()))
+
+def execute(session, query, explain=False):
+  compiled = query.statement.compile(dialect=sqlalchemy.dialects.postgresql.dialect())
+  cursor = session.connection().connection.cursor()
+  try:
+    cursor.execute(("EXPLAIN " if explain else "") + str(compiled), compiled.params)
+    return cursor.fetchall()
+  finally:
+    cursor.close()
+
+def main():
+  parser = argparse.ArgumentParser(description='check the plan of the highest tags query')
+  parser.add_argument('--team', default=None)
+  parser.add_argument('--repeat', type=int, default=5)
+  options = parser.parse_args()
+
+  session = Session()
+  named_trees = session.query(NamedTree) \
+      .filter((NamedTree.type == 'branch') & (NamedTree.name == None))
+  if options.team is not None:
+    named_trees = named_trees.join(NamedTree.package).join(Package.repository) \
+        .join(Repository.team).filter(Team.name == options.team)
+
+  queries = [ ('distinct on', Classifier.highest_tags(session, named_trees)),
+              ('correlated', correlated_max_version(session, named_trees)) ]
+  for name, query in queries:
+    timings = []
+    for i in range(options.repeat):
+      start = time.time()
+      rows = len(execute(session, query))
+      timings.append(time.time() - start)
+    print "{0:12} {1:7} rows  best {2:7.3f}s".format(name, rows, min(timings))
+
+  plan = "\n".join(row[0] for row in execute(session, queries[0][1], explain=True))
+  print plan
+  if 'SubPlan' in plan:
+    print "E: the highest tags are looked up with a subquery per tag"
+    sys.exit(1)
+  if 'named_tree_package_id_type_version_idx' not in plan:
+    print "I: the (package_id, type, version DESC) index is not used (small tables are scanned)"
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Time classifying and rendering the overview of a synthetic team.
+
+usage: bench/classify-render.py [--packages N] [--repeat N]
+
+The packages are plain objects with the attributes of the models used
+by `pet.classifier.ClassifiedPackage` and overview.pt, so no database
+content is needed (pet.models still connects on import).
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pet.classifier import ClassifiedPackage, Classifier
+
+import argparse
+import chameleon
+import datetime
+import random
+import time
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pet', 'web', 'templates', 'overview.pt')
+
+class Object(object):
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+class NamedTree(Object):
+  def link(self, filename, directory=False):
+    return "http://git.example.org/?p={0}.git;a=blob;f={1}".format(self.package.name, filename)
+
+class View(object):
+  def changelog_url(self, named_tree):
+    return "/changelog/{0}".format(named_tree.id)
+
+def synthetic_team(packages, seed=0):
+  """returns a list of (named_tree, bugs, suite_packages, tags) tuples"""
+  r = random.Random(seed)
+  result = []
+  when = datetime.datetime(2026, 1, 1)
+  for i in xrange(packages):
+    name = "libpackage{0}-perl".format(i)
+    package = Object(name=name)
+    released = "1.{0}-1".format(r.randint(0, 9))
+    version = r.choice([released, "1.10-1"])
+    watch = None
+    if r.random() < 0.9:
+      if r.random() < 0.05:
+        watch = Object(error="no matching files", upstream_version=None, debian_version=None, download_url=None, homepage=None)
+      else:
+        upstream = r.choice(["1.{0}".format(r.randint(0, 9)), "1.10"])
+        watch = Object(error=None, upstream_version=upstream, debian_version=version.split('-')[0],
+                       download_url="http://www.cpan.org/{0}-{1}.tar.gz".format(name, upstream), homepage="http://search.cpan.org/dist/{0}/".format(name))
+    trunk = NamedTree(id=2 * i, package=package, source=name, version=version,
+                      distribution=r.choice(["unstable", "UNRELEASED"]), last_changed_by="A Developer <a@example.org>",
+                      last_changed=when, todo=r.random() < 0.05, watch_result=watch)
+    tags = []
+    if r.random() < 0.95:
+      tags.append(NamedTree(id=2 * i + 1, package=package, version=released, last_changed_by=trunk.last_changed_by, last_changed=when))
+    suite_packages = [ Object(version=released) ] if r.random() < 0.9 else []
+    bugs = [ Object(bug_number=100000 + i * 10 + j, severity=r.choice(["wishlist", "minor", "normal", "important", "serious"]),
+                    subject="something is broken", forwarded=r.choice([None, "http://rt.cpan.org/"]),
+                    tags=r.sample(["patch", "pending", "moreinfo", "upstream", "wontfix"], r.randint(0, 2)))
+             for j in xrange(r.choice([0, 0, 0, 1, 2, 5])) ]
+    result.append((trunk, bugs, suite_packages, tags))
+  return result
+
+def classify(team):
+  classified = {}
+  for named_tree, bugs, suite_packages, tags in team:
+    p = ClassifiedPackage(named_tree, bugs, suite_packages, tags)
+    classified.setdefault(Classifier.classify_package(p), []).append(p)
+  return classified
+
+def main():
+  parser = argparse.ArgumentParser(description='benchmark classifying and rendering the overview')
+  parser.add_argument('--packages', type=int, default=5000)
+  parser.add_argument('--repeat', type=int, default=5)
+  options = parser.parse_args()
+
+  team = synthetic_team(options.packages)
+  template = chameleon.PageTemplateFile(TEMPLATE)
+  classify_timings = []
+  render_timings = []
+  for i in range(options.repeat):
+    start = time.time()
+    classified = classify(team)
+    classify_timings.append(time.time() - start)
+    start = time.time()
+    html = template(classified=classified, classes=Classifier.classes(), view=View())
+    render_timings.append(time.time() - start)
+
+  print "{0} packages: {1}".format(options.packages,
+      ", ".join("{0} {1}".format(key, len(classified[key])) for key in sorted(classified)))
+  print "classify  best {0:7.3f}s".format(min(classify_timings))
+  print "render    best {0:7.3f}s  {1:.1f} MiB".format(min(render_timings), len(html.encode('utf-8')) / 1048576.0)
+
+if __name__ == '__main__':
+  main()
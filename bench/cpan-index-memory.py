@@ -0,0 +1,105 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Compare peak RSS of loading CPAN's ls-lR.gz the old way (buffer the
+whole download, gunzip, keep a list of paths) with the streaming
+`pet.watch.CPAN` index.
+
+usage: bench/cpan-index-memory.py [--directories N] [--files N] [mirror-url]
+
+Without a mirror URL a synthetic ls-lR.gz is generated in a temporary
+directory and read through file://.  Each variant runs in a fresh
+process so the peak RSS figures do not influence each other.
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import gzip
+import resource
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import time
+import urllib2
+import urlparse
+
+def generate(directory, directories, files):
+  os.mkdir(os.path.join(directory, 'indices'))
+  fh = gzip.open(os.path.join(directory, 'indices', 'ls-lR.gz'), 'wb')
+  for d in xrange(directories):
+    fh.write("authors/id/A/AU/AUTHOR{0}:\n".format(d))
+    for f in xrange(files):
+      fh.write("-rw-r--r--   1 cpan     cpan       31337 Aug 10  1998 Some-Distribution{0}-{1}.tar.gz\n".format(d, f))
+      fh.write("-rw-r--r--   1 cpan     cpan         818 Aug 10  1998 Some-Distribution{0}-{1}.meta\n".format(d, f))
+    fh.write("\n")
+  fh.close()
+  return 'file://{0}/'.format(directory)
+
+def load_buffered(mirror):
+  import pet.watch
+  response = urllib2.urlopen(urlparse.urljoin(mirror, 'indices/ls-lR.gz'))
+  buf = StringIO.StringIO(response.read())
+  response.close()
+  contents = gzip.GzipFile(fileobj=buf, mode='rb')
+  # the list of paths as built before the streaming index
+  files = [ "{0}/{1}".format(d, n) for d, n in pet.watch.CPAN()._parse_files(contents) ]
+  contents.close()
+  return files
+
+def load_streaming(mirror):
+  import pet.watch
+  return pet.watch.CPAN(mirror).files
+
+def measure(variant, mirror):
+  import pet.watch # exclude module import from the timing
+  start = time.time()
+  files = globals()['load_' + variant](mirror)
+  elapsed = time.time() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print "{0:10} {1:8} paths {2:8.2f}s  peak RSS {3:8.1f} MiB".format(variant, len(files), elapsed, peak / 1024.0)
+
+def main():
+  parser = argparse.ArgumentParser(description='benchmark memory use of the CPAN file index')
+  parser.add_argument('--directories', type=int, default=20000)
+  parser.add_argument('--files', type=int, default=10)
+  parser.add_argument('--variant', help=argparse.SUPPRESS)
+  parser.add_argument('mirror', nargs='?')
+  options = parser.parse_args()
+
+  if options.variant:
+    measure(options.variant, options.mirror)
+    return
+
+  tmpdir = None
+  mirror = options.mirror
+  try:
+    if mirror is None:
+      tmpdir = tempfile.mkdtemp(prefix='pet-bench-')
+      mirror = generate(tmpdir, options.directories, options.files)
+    for variant in ('buffered', 'streaming'):
+      sys.stdout.flush()
+      subprocess.check_call([sys.executable, os.path.abspath(__file__), '--variant', variant, mirror])
+  finally:
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Report the space used by stored files and the time taken by the
+queries reading them.
+
+usage: bench/file-store.py [--no-cert] [--repeat N]
+
+Works with the schema before (file.contents) and after (blob table)
+the move to content-addressed blobs, so running it before and after
+the database update shows the space saved and the change in query
+time.  It does not use `pet.models`, which needs the current schema.
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pet
+
+import argparse
+import time
+
+_queries = {
+  'watch files': """
+    SELECT f.named_tree_id, {contents} FROM file f {join}
+      JOIN named_tree nt ON nt.id = f.named_tree_id AND nt.commit_id = f.commit_id
+     WHERE f.name = 'debian/watch'""",
+  'trunk changelogs': """
+    SELECT f.named_tree_id, {contents} FROM file f {join}
+      JOIN named_tree nt ON nt.id = f.named_tree_id AND nt.commit_id = f.commit_id
+     WHERE f.name = 'debian/changelog' AND nt.type = 'branch' AND nt.name IS NULL""",
+  'file names': """
+    SELECT f.named_tree_id, f.name FROM file f
+      JOIN named_tree nt ON nt.id = f.named_tree_id AND nt.commit_id = f.commit_id""",
+}
+
+def size(connection, relation):
+  return connection.execute("SELECT pg_total_relation_size(%s)", relation).scalar()
+
+def main():
+  parser = argparse.ArgumentParser(description='report space and query time of stored files')
+  parser.add_argument('-nc', '--no-cert', dest='no_cert', action='store_true', default=False)
+  parser.add_argument('--repeat', type=int, default=5)
+  options = parser.parse_args()
+
+  connection = pet.engine(options.no_cert).connect()
+  blobs = connection.execute("SELECT count(*) FROM information_schema.columns WHERE table_name = 'file' AND column_name = 'blob_hash'").scalar() != 0
+
+  files = connection.execute("SELECT count(*) FROM file").scalar()
+  if blobs:
+    logical = connection.execute("SELECT coalesce(sum(b.size), 0) FROM file f JOIN blob b ON b.hash = f.blob_hash").scalar()
+    stored = connection.execute("SELECT count(*), coalesce(sum(octet_length(data)), 0) FROM blob").fetchone()
+    on_disk = size(connection, 'file') + size(connection, 'blob')
+    print "{0} files, {1} blobs".format(files, stored[0])
+    print "contents: {0:.1f} MiB, stored as {1:.1f} MiB".format(logical / 1048576.0, stored[1] / 1048576.0)
+    fmt = dict(contents='b.compression, b.data', join='LEFT JOIN blob b ON b.hash = f.blob_hash')
+  else:
+    logical = connection.execute("SELECT coalesce(sum(octet_length(contents)), 0) FROM file").scalar()
+    on_disk = size(connection, 'file')
+    print "{0} files".format(files)
+    print "contents: {0:.1f} MiB".format(logical / 1048576.0)
+    fmt = dict(contents='f.contents', join='')
+  print "on disk (with indices and TOAST): {0:.1f} MiB".format(on_disk / 1048576.0)
+
+  for name in sorted(_queries):
+    query = _queries[name].format(**fmt)
+    timings = []
+    for i in range(options.repeat):
+      start = time.time()
+      rows = len(connection.execute(query).fetchall())
+      timings.append(time.time() - start)
+    print "{0:20} {1:7} rows  best {2:7.3f}s".format(name, rows, min(timings))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Compare reading the files of every tag of a git-local repository with
+one ``git cat-file blob`` process per file against `pet.vcs.GitLocal`'s
+persistent ``git cat-file --batch`` process.
+
+usage: bench/git-cat-file.py [--tags N]
+
+A synthetic package repository with N tags is created in a temporary
+directory with git fast-import.
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pet.vcs
+
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+# as in pet.update.NamedTreeUpdater.filenames (pet.update needs a database)
+FILENAMES = ("debian/patches/series", "debian/control", "debian/changelog", "debian/watch")
+
+class Repository(object):
+  """the attributes of `pet.models.Repository` used by GitLocal"""
+  type = 'git-local'
+  web_root = 'http://localhost/'
+  def __init__(self, root):
+    self.root = root
+
+def create_repository(path, tags):
+  subprocess.check_call(['git', 'init', '--quiet', '--bare', path])
+  p = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+  changelog = ""
+  for i in xrange(tags):
+    changelog = "pkg (1.{0}-1) unstable; urgency=low\n\n  * Release {0}.\n\n -- A <a@example.org>  Mon, 01 Jan 2001 00:00:00 +0000\n\n".format(i) + changelog
+    files = { 'debian/changelog': changelog, 'debian/control': "Source: pkg\nMaintainer: A <a@example.org>\n",
+              'debian/watch': "version=3\nhttp://example.org/ pkg-(.*)\\.tar\\.gz\n" }
+    p.stdin.write("commit refs/heads/master\ncommitter A <a@example.org> {0} +0000\ndata 3\nrel\n".format(1000000000 + i))
+    for name, contents in files.iteritems():
+      p.stdin.write("M 100644 inline {0}\ndata {1}\n{2}\n".format(name, len(contents), contents))
+    p.stdin.write("\nreset refs/tags/debian/1.{0}-1\nfrom refs/heads/master\n\n".format(i))
+  p.stdin.close()
+  if p.wait():
+    raise Exception("git fast-import failed")
+
+def read_forking(cwd, tags):
+  for tag in tags:
+    for filename in FILENAMES:
+      p = subprocess.Popen(['git', 'cat-file', 'blob', '{0}:{1}'.format(tag, filename)], cwd=cwd,
+          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      p.communicate()
+  return len(tags) * len(FILENAMES)
+
+def read_batch(vcs, tags):
+  for tag in tags:
+    vcs.files('pkg', FILENAMES, tag=tag)
+  vcs.close()
+  return 1
+
+def main():
+  parser = argparse.ArgumentParser(description='benchmark reading files from git-local repositories')
+  parser.add_argument('--tags', type=int, default=500)
+  options = parser.parse_args()
+
+  tmpdir = tempfile.mkdtemp(prefix='pet-bench-')
+  try:
+    cwd = os.path.join(tmpdir, 'packages.d', 'pkg.git')
+    create_repository(cwd, options.tags)
+    tags = [ "debian/1.{0}-1".format(i) for i in xrange(options.tags) ]
+    files = len(tags) * len(FILENAMES)
+
+    start = time.time()
+    forks = read_forking(cwd, tags)
+    elapsed = time.time() - start
+    print "{0:10} {1:6} files {2:6} forks {3:7.2f}s {4:8.0f} files/s".format('forking', files, forks, elapsed, files / elapsed)
+
+    vcs = pet.vcs.GitLocal(Repository(os.path.join(tmpdir, 'packages')))
+    start = time.time()
+    forks = read_batch(vcs, tags)
+    elapsed = time.time() - start
+    print "{0:10} {1:6} files {2:6} forks {3:7.2f}s {4:8.0f} files/s".format('batch', files, forks, elapsed, files / elapsed)
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
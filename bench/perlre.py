@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Microbenchmark for applying version mangles from watch files.
+
+usage: bench/perlre.py [--links N] [path...]
+
+Each path is a watch file or a directory that is searched for
+debian/watch files (e.g. a directory of package checkouts).  Without
+paths a small built-in corpus of watch files is used.  Every mangle is
+applied to N version strings, as uversionmangle is for the links found
+on an upstream page, once re-parsing the expression for each call and
+once through the compiled-expression cache.
+"""
+
+import os.path
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pet.perlre
+import pet.watch
+
+import argparse
+import time
+
+_corpus = [
+  r"""version=3
+https://metacpan.org/release/Moose .*/Moose-v?(\d[\d.-]*)\.(?:tar(?:\.gz|\.bz2)?|tgz|zip)$
+""",
+  r"""version=3
+opts=dversionmangle=s/\+dfsg\d*$//,uversionmangle=s/(\d)[_\.\-\+]?((RC|rc|pre|dev|beta|alpha)\d*)$/$1~$2/ \
+https://github.com/example/project/tags .*/v?(\d\S*)\.tar\.gz
+""",
+  r"""version=3
+opts=uversionmangle=s/_/./g;s/^(\d+\.\d+)$/$1.0/ \
+http://sf.net/example/example-(\d[\d.]*)\.tar\.gz
+""",
+  r"""version=3
+opts="dversionmangle=s/\+(debian|dfsg|ds|deb)(\.?\d+)?$//,uversionmangle=s/^/0./" \
+https://example.org/releases/ example-(\d+)\.tar\.xz
+""",
+  r"""version=3
+opts=versionmangle=s/-/./g;s/[Bb]eta/~beta/i \
+http://example.net/download.html example-([\d.-]+(?:beta\d*)?)\.tar\.bz2
+""",
+]
+
+def watch_files(paths):
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        if os.path.basename(root) == 'debian' and 'watch' in files:
+          with open(os.path.join(root, 'watch'), 'r') as fh:
+            yield fh.read()
+    else:
+      with open(path, 'r') as fh:
+        yield fh.read()
+
+def mangles(contents):
+  result = []
+  for watch in contents:
+    try:
+      rules = pet.watch.WatchFile(watch).rules
+    except Exception:
+      continue
+    for rule in rules:
+      for key in ('uversionmangle', 'dversionmangle', 'versionmangle'):
+        result.extend(rule.options.get(key, []))
+  return result
+
+def bench(name, function, expressions, versions):
+  start = time.time()
+  for expression in expressions:
+    for version in versions:
+      function(expression, version)
+  elapsed = time.time() - start
+  calls = len(expressions) * len(versions)
+  print "{0:10} {1:8} calls {2:8.3f}s {3:10.0f} calls/s".format(name, calls, elapsed, calls / elapsed)
+
+def main():
+  parser = argparse.ArgumentParser(description='benchmark version mangling')
+  parser.add_argument('--links', type=int, default=500,
+                      help='number of versions each mangle is applied to')
+  parser.add_argument('paths', nargs='*')
+  options = parser.parse_args()
+
+  if options.paths:
+    expressions = mangles(watch_files(options.paths))
+  else:
+    expressions = mangles(_corpus)
+  versions = [ "{0}.{1}_{2}beta{3}".format(i // 100, i % 100, i % 7, i % 3) for i in range(options.links) ]
+  print "{0} mangles, {1} versions each".format(len(expressions), len(versions))
+
+  bench('uncached', lambda e, s: pet.perlre._compile_perlre(e)(s), expressions, versions)
+  bench('cached', pet.perlre.apply_perlre, expressions, versions)
+
+if __name__ == '__main__':
+  main()
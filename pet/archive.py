@@ -0,0 +1,315 @@
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Access to the indices of Debian archive mirrors.
+
+Indices are downloaded and decompressed while they are parsed, nothing
+but the cache is written to disk.  Where the mirror provides pdiffs,
+a cached copy of an index is updated with them instead of downloading
+the whole index again.  Mirrors can be given as http://, https:// or
+file:// URLs.
+"""
+
+from pet.exceptions import *
+import pet.cache
+
+import debian.deb822
+import glob
+import hashlib
+import httplib
+import os
+import os.path
+import re
+import socket
+import tempfile
+import urllib2
+import zlib
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+CHUNK_SIZE = 64 * 1024
+# seconds to wait for a mirror before giving up
+TIMEOUT = 180
+
+def _fetch(url, headers, timeout=TIMEOUT):
+  """fetch function for `pet.cache.PageCache`"""
+  response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=timeout)
+  try:
+    return response.info(), response.read()
+  finally:
+    response.close()
+
+def _decompressor(name):
+  """returns a decompressor for the index `name`, or None if it is not compressed"""
+  if name.endswith('.xz'):
+    return lzma.LZMADecompressor()
+  elif name.endswith('.gz'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  return None
+
+def _extensions():
+  """compressed variants of indices we can read, best first"""
+  if lzma is not None:
+    return ('.xz', '.gz', '')
+  return ('.gz', '')
+
+class IndexFile(object):
+  """an index listed in a Release file"""
+  def __init__(self, name, sha256, size):
+    self.name = name
+    self.sha256 = sha256
+    self.size = int(size)
+
+class Release(object):
+  """the Release file of a suite
+
+  InRelease is used if the mirror has one, Release otherwise.  The
+  signature is not checked.  If `cache` is a `pet.cache.PageCache`, the
+  file is only downloaded again when it changed.  Requests time out
+  after `timeout` seconds.
+  """
+  def __init__(self, mirror, suite, cache=None, timeout=TIMEOUT):
+    self.base = "{0}/dists/{1}/".format(mirror.rstrip('/'), suite)
+    self.timeout = timeout
+    if cache is None:
+      cache = pet.cache.PageCache()
+    fetch = lambda url, headers: _fetch(url, headers, timeout)
+    try:
+      contents = cache.get(self.base + 'InRelease', fetch)
+    except urllib2.URLError:
+      contents = cache.get(self.base + 'Release', fetch)
+    release = debian.deb822.Release(contents.splitlines(True))
+    self.files = {}
+    for entry in release.get('SHA256', []):
+      self.files[entry['name']] = IndexFile(entry['name'], entry['sha256'], entry['size'])
+  def index(self, name):
+    """returns the best variant of index `name` we can read, or None"""
+    for extension in _extensions():
+      index = self.files.get(name + extension)
+      if index is not None:
+        return index
+    return None
+  def hash(self, name):
+    """
+    returns the SHA-256 sum of the uncompressed index `name`, or None
+    if the Release file does not list it
+    """
+    index = self.files.get(name)
+    if index is None:
+      return None
+    return index.sha256
+
+_re_ed_command = re.compile(r'\A(\d+)(?:,(\d+))?([acd])\Z')
+
+def apply_ed(lines, script):
+  """apply the ed script `script`, as written by ``diff --ed``, to `lines`
+
+  Both are lists of lines including their newline; `lines` is changed
+  in place.  Besides the a, c and d commands only "s/.//" is supported,
+  which dak uses for lines consisting of a single dot.
+  """
+  script = iter(script)
+  current = None
+  for command in script:
+    command = command.rstrip("\n")
+    if command == 's/.//':
+      lines[current] = lines[current][1:]
+      continue
+    match = _re_ed_command.match(command)
+    if match is None:
+      raise ArchiveException("Unsupported ed command '{0}'".format(command))
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    action = match.group(3)
+    text = []
+    if action in ('a', 'c'):
+      for line in script:
+        if line.rstrip("\n") == '.':
+          break
+        text.append(line)
+    if action == 'a':
+      lines[first:first] = text
+      current = first + len(text) - 1
+    elif action == 'c':
+      lines[first - 1:last] = text
+      current = first + len(text) - 2
+    else:
+      del lines[first - 1:last]
+      current = first - 2
+
+class PDiffIndex(object):
+  """the Index of a directory of pdiffs (e.g. Sources.diff/Index)"""
+  def __init__(self, lines):
+    index = debian.deb822.Deb822(lines)
+    def entries(field):
+      return [ line.split() for line in index.get(field, '').splitlines() if line.strip() ]
+    current = index.get('SHA256-Current', '').split()
+    self.current = current[0] if current else None
+    self.history = entries('SHA256-History')
+    self.downloads = dict((name, (sha256, size)) for sha256, size, name in entries('SHA256-Download'))
+    # With "merged" patches each patch leads directly to the current version.
+    self.merged = index.get('X-Patch-Precedence') == 'merged'
+  def patches(self, sha256):
+    """
+    returns the names of the patches to apply to the version with hash
+    `sha256` to get the current one, or None if it is not known
+    """
+    for i, (known, size, name) in enumerate(self.history):
+      if known == sha256:
+        if self.merged:
+          return [name]
+        return [ entry[2] for entry in self.history[i:] ]
+    return None
+
+class IndexReader(object):
+  """read indices of a mirror, keeping the last copy of each in a cache
+
+  Downloads are checked against the SHA-256 sums given in the Release
+  file.  If `cache_directory` is given, the last copy of each index is
+  kept there uncompressed.  It is used instead of downloading the index
+  while its hash does not change, and as base for pdiffs otherwise.
+  Downloads use the timeout of `release`.
+  """
+  def __init__(self, release, cache_directory=None):
+    self.release = release
+    self.cache_directory = cache_directory
+    if cache_directory is not None and not os.path.isdir(cache_directory):
+      os.makedirs(cache_directory)
+  def _copy_prefix(self, name):
+    key = hashlib.sha1(self.release.base + name).hexdigest()
+    return os.path.join(self.cache_directory, 'index-{0}-'.format(key))
+  def _copy(self, name, sha256):
+    """returns the path of the cached copy of `name` with hash `sha256`, or None"""
+    if self.cache_directory is None or sha256 is None:
+      return None
+    path = self._copy_prefix(name) + sha256
+    if not os.path.exists(path):
+      return None
+    return path
+  def _store(self, name, sha256, lines):
+    """yields `lines` while storing them as the cached copy of `name`"""
+    if self.cache_directory is None or sha256 is None:
+      for line in lines:
+        yield line
+      return
+    fd, tmp = tempfile.mkstemp(dir=self.cache_directory, prefix='.tmp-')
+    try:
+      checksum = hashlib.sha256()
+      with os.fdopen(fd, 'wb') as fh:
+        for line in lines:
+          checksum.update(line)
+          fh.write(line)
+          yield line
+      if checksum.hexdigest() == sha256:
+        prefix = self._copy_prefix(name)
+        for old in glob.glob(prefix + '*'):
+          os.unlink(old)
+        os.rename(tmp, prefix + sha256)
+        tmp = None
+    finally:
+      if tmp is not None:
+        os.unlink(tmp)
+  def _chunks(self, index):
+    """yields the (compressed) contents of `index` in chunks"""
+    response = urllib2.urlopen(self.release.base + index.name, timeout=self.release.timeout)
+    try:
+      checksum = hashlib.sha256()
+      size = 0
+      for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+        checksum.update(chunk)
+        size += len(chunk)
+        yield chunk
+      if size != index.size or checksum.hexdigest() != index.sha256:
+        raise ArchiveException("{0}{1} does not match the Release file".format(self.release.base, index.name))
+    finally:
+      response.close()
+  def _download(self, index):
+    """yields the lines of the decompressed `index`"""
+    decompressor = _decompressor(index.name)
+    pending = ''
+    for chunk in self._chunks(index):
+      if decompressor is not None:
+        chunk = decompressor.decompress(chunk)
+      lines = (pending + chunk).split("\n")
+      pending = lines.pop()
+      for line in lines:
+        yield line + "\n"
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+      pending += decompressor.flush()
+    if pending:
+      yield pending
+  def lines(self, name):
+    """yields the lines of the uncompressed index `name` (e.g. main/source/Sources)"""
+    sha256 = self.release.hash(name)
+    path = self._copy(name, sha256)
+    if path is not None:
+      with open(path, 'rb') as fh:
+        for line in fh:
+          yield line
+      return
+    index = self.release.index(name)
+    if index is None:
+      raise ArchiveException("{0}{1} is not listed in the Release file".format(self.release.base, name))
+    for line in self._store(name, sha256, self._download(index)):
+      yield line
+  def patched(self, name, known):
+    """update the cached copy of `name` with hash `known` using pdiffs
+
+    Returns a tuple (old, new) with the lines of the cached copy and of
+    the current index, or None if the copy or suitable pdiffs are not
+    available.  pdiffs that cannot be downloaded in time are treated as
+    not available.
+    """
+    sha256 = self.release.hash(name)
+    path = self._copy(name, known)
+    pdiff_index = self.release.files.get(name + '.diff/Index')
+    if path is None or sha256 is None or pdiff_index is None:
+      return None
+    try:
+      pdiffs = PDiffIndex(list(self._download(pdiff_index)))
+      if pdiffs.current != sha256:
+        return None
+      patches = pdiffs.patches(known)
+      if patches is None:
+        return None
+
+      with open(path, 'rb') as fh:
+        old = fh.readlines()
+      new = list(old)
+      for patch in patches:
+        download = pdiffs.downloads.get(patch + '.gz')
+        if download is None:
+          return None
+        index = IndexFile("{0}.diff/{1}.gz".format(name, patch), download[0], download[1])
+        apply_ed(new, list(self._download(index)))
+    except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+      print "D: Could not download pdiffs for {0}{1}: {2}".format(self.release.base, name, e)
+      return None
+    if sha256 != hashlib.sha256("".join(new)).hexdigest():
+      raise ArchiveException("Patching {0}{1} did not give the expected result".format(self.release.base, name))
+    for line in self._store(name, sha256, new):
+      pass
+    print "D: Applied {0} pdiffs to {1}{2}".format(len(patches), self.release.base, name)
+    return old, new
+  def paragraphs(self, lines):
+    """yields the paragraphs of a Sources or Packages index given as `lines`"""
+    return debian.deb822.Sources.iter_paragraphs(lines, use_apt_pkg=False)
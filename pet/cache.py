@@ -0,0 +1,234 @@
+# vim:ts=2:sw=2:et:ai:sts=2
+# Copyright 2026, The PET developers
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Caches shared by the updaters and the web interface.
+"""
+
+import collections
+import glob
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+import urllib2
+
+class LRUCache(object):
+  """thread-safe mapping holding at most `size` recently used items"""
+  def __init__(self, size):
+    self.size = size
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+  def __len__(self):
+    return len(self._items)
+  def __contains__(self, key):
+    return key in self._items
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        value = self._items.pop(key)
+      except KeyError:
+        return default
+      self._items[key] = value
+      return value
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      while len(self._items) > self.size:
+        self._items.popitem(last=False)
+
+def _write_atomically(path, contents):
+  """write `contents` to `path` so readers never see a partial file"""
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'wb') as fh:
+      fh.write(contents)
+    os.rename(tmp, path)
+  except:
+    os.unlink(tmp)
+    raise
+
+class PageCache(object):
+  """cache for downloaded pages
+
+  Pages are kept in memory while the cache object lives.  If
+  `directory` is given, they are also stored on disk together with
+  their ETag and Last-Modified headers: pages younger than `ttl` seconds
+  are used without asking the server, older ones are revalidated with a
+  conditional request.  `expire` keeps the on-disk cache below
+  `max_size` bytes by removing the least recently used pages.
+  """
+  def __init__(self, directory=None, ttl=6 * 3600, max_size=256 * 1024 * 1024, memory_size=512):
+    self.directory = directory
+    self.ttl = ttl
+    self.max_size = max_size
+    self._memory = LRUCache(memory_size)
+    self._lock = threading.Lock()
+    self._url_locks = {}
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.not_modified = 0
+    self.misses = 0
+    if directory is not None and not os.path.isdir(directory):
+      os.makedirs(directory)
+  def _count(self, counter):
+    with self._lock:
+      setattr(self, counter, getattr(self, counter) + 1)
+  def _paths(self, url):
+    base = os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+    return base + '.json', base + '.data'
+  def _load(self, url):
+    meta_path, data_path = self._paths(url)
+    try:
+      with open(meta_path, 'r') as fh:
+        meta = json.load(fh)
+      with open(data_path, 'rb') as fh:
+        contents = fh.read()
+    except (IOError, OSError, ValueError):
+      return None, None
+    return meta, contents
+  def _save(self, url, meta, contents=None):
+    meta_path, data_path = self._paths(url)
+    if contents is not None:
+      _write_atomically(data_path, contents)
+    _write_atomically(meta_path, json.dumps(meta))
+  def get(self, url, fetch):
+    """returns the contents of `url`
+
+    `fetch` is called as ``fetch(url, headers)`` and must return a tuple
+    ``(info, contents)`` with `info` a `mimetools.Message` as returned by
+    ``urllib2.urlopen(...).info()``.  It has to raise `urllib2.HTTPError`
+    for "304 Not Modified" responses, as urllib2 does.
+    """
+    with self._lock:
+      url_lock = self._url_locks.setdefault(url, threading.Lock())
+    # Only one thread downloads a given URL, the others wait for it.
+    with url_lock:
+      contents = self._memory.get(url)
+      if contents is not None:
+        self._count('memory_hits')
+        return contents
+      if self.directory is None:
+        contents = fetch(url, {})[1]
+        self._count('misses')
+      else:
+        contents = self._get(url, fetch)
+      self._memory[url] = contents
+      return contents
+  def _get(self, url, fetch):
+    meta, contents = self._load(url)
+    headers = {}
+    if meta is not None:
+      if time.time() - meta['fetched'] < self.ttl:
+        os.utime(self._paths(url)[0], None)
+        self._count('disk_hits')
+        return contents
+      if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+      if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+      info, new_contents = fetch(url, headers)
+    except urllib2.HTTPError as e:
+      if e.code != 304 or meta is None:
+        raise
+      meta['fetched'] = time.time()
+      self._save(url, meta)
+      self._count('not_modified')
+      return contents
+
+    meta = dict(url=url, fetched=time.time(),
+        etag=info.getheader('ETag'), last_modified=info.getheader('Last-Modified'))
+    self._save(url, meta, new_contents)
+    self._count('misses')
+    return new_contents
+  def expire(self):
+    """remove least recently used pages until the cache fits in `max_size`"""
+    if self.directory is None:
+      return
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      if not name.endswith('.json'):
+        continue
+      meta_path = os.path.join(self.directory, name)
+      data_path = meta_path[:-len('.json')] + '.data'
+      try:
+        size = os.path.getsize(data_path)
+        entries.append((os.path.getmtime(meta_path), size, meta_path, data_path))
+      except OSError:
+        continue
+      total += size
+    entries.sort()
+    for mtime, size, meta_path, data_path in entries:
+      if total <= self.max_size:
+        break
+      for path in (meta_path, data_path):
+        try:
+          os.unlink(path)
+        except OSError:
+          pass
+      total -= size
+  def statistics(self):
+    return "{0} memory hits, {1} disk hits, {2} not modified, {3} downloaded".format(
+        self.memory_hits, self.disk_hits, self.not_modified, self.misses)
+
+class ResponseCache(object):
+  """cache for rendered responses
+
+  Entries are identified by a `name` and a `generation`; storing a
+  generation of a name replaces all others.  The last `memory_size`
+  entries used are kept in memory.  If `directory` is given, entries
+  are also stored there and shared with other processes.
+  """
+  def __init__(self, directory=None, memory_size=16):
+    self.directory = directory
+    self._memory = LRUCache(memory_size)
+    if directory is not None and not os.path.isdir(directory):
+      os.makedirs(directory)
+  def _prefix(self, name):
+    if isinstance(name, unicode):
+      name = name.encode('utf-8')
+    return os.path.join(self.directory, hashlib.sha1(name).hexdigest() + '-')
+  def get(self, name, generation):
+    """returns the entry for `name` and `generation`, or None"""
+    contents = self._memory.get((name, generation))
+    if contents is not None or self.directory is None:
+      return contents
+    try:
+      with open(self._prefix(name) + str(generation), 'rb') as fh:
+        contents = fh.read()
+    except (IOError, OSError):
+      return None
+    self._memory[(name, generation)] = contents
+    return contents
+  def put(self, name, generation, contents):
+    self._memory[(name, generation)] = contents
+    if self.directory is None:
+      return
+    prefix = self._prefix(name)
+    path = prefix + str(generation)
+    _write_atomically(path, contents)
+    for old in glob.glob(prefix + '*'):
+      if old != path:
+        try:
+          os.unlink(old)
+        except OSError:
+          pass
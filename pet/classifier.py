@@ -16,95 +16,58 @@
 from pet.models import *
 
 import apt_pkg
+import json
 import sqlalchemy
 import sqlalchemy.orm
+import sqlalchemy.sql
+
+_rc_severities = frozenset(('serious', 'grave', 'critical'))
+_no_todo_tags = frozenset(('fixed-upstream', 'pending', 'wontfix', 'moreinfo'))
 
 class ClassifiedPackage(object):
+  """a trunk together with its bugs, suite packages and highest tags
+
+  All predicates used by `Classifier.classify_package` and the overview
+  are computed once here instead of on every access.
+  """
+  __slots__ = ('named_tree', 'bugs', 'suite_packages', 'tags', 'watch',
+               'name', 'source', 'version', 'distribution', 'last_changed_by', 'last_changed', 'todo',
+               'highest_tag', 'highest_archive', 'archive_version',
+               'has_rc_bugs', 'todo_bugs', 'is_tagged', 'is_in_archive', 'missing_tag', 'ready_for_upload',
+               'newer_upstream', 'watch_problem')
   def __init__(self, named_tree, bugs, suite_packages, tags):
     self.named_tree = named_tree
     self.bugs = bugs
     self.suite_packages = suite_packages
     self.tags = tags
-    self.watch = self.named_tree.watch_result
-  name = property(lambda self: self.named_tree.package.name)
-  source = property(lambda self: self.named_tree.source)
-  version = property(lambda self: self.named_tree.version)
-  distribution = property(lambda self: self.named_tree.distribution)
-  last_changed_by = property(lambda self: self.named_tree.last_changed_by)
-  last_changed = property(lambda self: self.named_tree.last_changed)
-  todo = property(lambda self: self.named_tree.todo)
-
-  @property
-  def has_rc_bugs(self):
-    for b in self.bugs:
-      if b.severity in ('serious', 'grave', 'critical'):
-        return True
-    return False
-
-  @property
-  def ready_for_upload(self):
-    highest_tag = self.highest_tag
-    if self.distribution is not None and self.distribution != 'UNRELEASED' and not self.is_tagged and not self.is_in_archive:
-      return True
-    return False
-
-  @property
-  def is_tagged(self):
-    for t in self.tags:
-      if t.version == self.version:
-        return True
-    return False
-
-  @property
-  def missing_tag(self):
-    if self.is_in_archive and not self.is_tagged:
-      return True
-    return False
-
-  @property
-  def is_in_archive(self):
-    for sp in self.suite_packages:
-      if sp.version == self.version:
-        return True
-    return False
-
-  @property
-  def highest_tag(self):
-    try:
-      return self.tags[0]
-    except IndexError:
-      return None
-
-  @property
-  def highest_archive(self):
-    try:
-      return self.suite_packages[0]
-    except IndexError:
-      return None
-
-  @property
-  def todo_bugs(self):
-    for b in self.bugs:
-      if not b.forwarded and 'fixed-upstream' not in b.tags and 'pending' not in b.tags and 'wontfix' not in b.tags and 'moreinfo' not in b.tags:
-        return True
-    return False
-
-  @property
-  def newer_upstream(self):
-    if self.watch and self.watch.upstream_version:
-      return apt_pkg.version_compare(self.watch.upstream_version,
-          self.watch.debian_version) > 0
-    return False
-
-  @property
-  def watch_problem(self):
-    if self.watch:
-      if self.watch.error is not None:
-        return True
-      if apt_pkg.version_compare(self.watch.upstream_version,
-          self.watch.debian_version) < 0:
-        return True
-    return False
+    self.watch = watch = named_tree.watch_result
+    self.name = named_tree.package.name
+    self.source = named_tree.source
+    self.version = version = named_tree.version
+    self.distribution = distribution = named_tree.distribution
+    self.last_changed_by = named_tree.last_changed_by
+    self.last_changed = named_tree.last_changed
+    self.todo = named_tree.todo
+
+    self.highest_tag = tags[0] if tags else None
+    self.highest_archive = suite_packages[0] if suite_packages else None
+    self.archive_version = self.highest_archive.version if suite_packages else None
+
+    self.has_rc_bugs = any(b.severity in _rc_severities for b in bugs)
+    self.todo_bugs = any(not b.forwarded and _no_todo_tags.isdisjoint(b.tags) for b in bugs)
+    self.is_tagged = is_tagged = any(t.version == version for t in tags)
+    self.is_in_archive = is_in_archive = any(sp.version == version for sp in suite_packages)
+    self.missing_tag = is_in_archive and not is_tagged
+    self.ready_for_upload = distribution is not None and distribution != 'UNRELEASED' and not is_tagged and not is_in_archive
+
+    self.newer_upstream = self.watch_problem = False
+    if watch:
+      if watch.upstream_version and watch.debian_version:
+        compared = apt_pkg.version_compare(watch.upstream_version, watch.debian_version)
+      else:
+        compared = 0
+      self.newer_upstream = compared > 0
+      self.watch_problem = watch.error is not None or compared < 0
 
 class Classifier(object):
   def __init__(self, session, named_trees, suite_condition, bug_tracker_condition):
@@ -134,51 +97,56 @@ class Classifier(object):
     for sp in suite_packages_query:
       suite_packages.setdefault(sp.source, []).append(sp)
 
-    Tags = sqlalchemy.orm.aliased(NamedTree)
-    Reference = sqlalchemy.orm.aliased(NamedTree)
-    max_version = session.query(sqlalchemy.func.max(Reference.version)) \
-        .filter(Reference.type == 'tag') \
-        .filter(Reference.package_id == Tags.package_id) \
-        .correlate(Tags) \
-        .as_scalar()
-
-    tags_query = session.query(Tags) \
-        .filter(Tags.type == 'tag') \
-        .filter(Tags.version == max_version) \
-        .order_by(Tags.package_id, Tags.version.desc()) \
-        .filter(Tags.package_id.in_(named_trees.from_self(NamedTree.package_id).subquery()))
     tags = {}
-    for t in tags_query:
+    for t in self.highest_tags(session, named_trees):
       tags.setdefault(t.package_id, []).append(t)
 
     self.packages = []
     for nt in sorted_named_trees:
       self.packages.append(ClassifiedPackage(nt, bugs.get(nt.source, []), suite_packages.get(nt.source, []), tags.get(nt.package_id, [])))
 
+  @staticmethod
+  def highest_tags(session, named_trees):
+    """returns a query for the highest tag of the packages of `named_trees`
+
+    DISTINCT ON reads the tags from the (package_id, type, version DESC)
+    index of named_tree; see bench/classifier-tags.py.
+    """
+    Tags = sqlalchemy.orm.aliased(NamedTree)
+    return session.query(Tags) \
+        .filter(Tags.type == 'tag') \
+        .filter(Tags.version != None) \
+        .distinct(Tags.package_id) \
+        .order_by(Tags.package_id, Tags.version.desc(), Tags.id) \
+        .filter(Tags.package_id.in_(named_trees.from_self(NamedTree.package_id).subquery()))
+  @staticmethod
+  def classify_package(p):
+    """returns the key of the class of the `ClassifiedPackage` `p`"""
+    if p.ready_for_upload:
+      return 'ready_for_upload'
+    elif p.has_rc_bugs:
+      return 'rc_bugs'
+    elif p.missing_tag:
+      return 'missing_tag'
+    elif not p.tags:
+      return 'new'
+    elif p.newer_upstream:
+      return 'new_upstream'
+    elif p.watch_problem:
+      return 'watch_problem'
+    elif p.bugs:
+      return 'bugs'
+    elif not p.is_tagged:
+      return 'wip'
+    else:
+      return 'other'
   def classify(self):
     classified = dict()
     for p in self.packages:
-      if p.ready_for_upload:
-        cls = 'ready_for_upload'
-      elif p.has_rc_bugs:
-        cls = 'rc_bugs'
-      elif p.missing_tag:
-        cls = 'missing_tag'
-      elif not p.tags:
-        cls = 'new'
-      elif p.newer_upstream:
-        cls = 'new_upstream'
-      elif p.watch_problem:
-        cls = 'watch_problem'
-      elif p.bugs:
-        cls = 'bugs'
-      elif not p.is_tagged:
-        cls = 'wip'
-      else:
-        cls = 'other'
-      classified.setdefault(cls, []).append(p)
+      classified.setdefault(self.classify_package(p), []).append(p)
     return classified
-  def classes(self):
+  @staticmethod
+  def classes():
     return [
       { 'name': "Ready For Upload", 'key': 'ready_for_upload' },
       { 'name': "Packages with RC bugs", 'key': 'rc_bugs' },
@@ -190,3 +158,54 @@ class Classifier(object):
       { 'name': 'Work in progress', 'key': 'wip' },
       #{ 'name': "Other packages", 'key': 'other' },
       ]
+
+def refresh_package_status(session, condition=None):
+  """recompute `PackageStatus` rows
+
+  Only trunks matching `condition`, an SQL expression on `NamedTree`
+  such as ``NamedTree.source.in_(sources)``, are classified again; all
+  trunks are if it is None or if no status was computed so far.
+  """
+  # Updaters refreshing the same packages would otherwise both insert
+  # their rows; this still allows the overview to read the table.
+  session.execute("LOCK TABLE package_status IN SHARE ROW EXCLUSIVE MODE")
+  if condition is not None and session.query(PackageStatus.named_tree_id).first() is None:
+    print "I: No package status found, refreshing all packages"
+    condition = None
+  named_trees = session.query(NamedTree) \
+      .filter((NamedTree.type == 'branch') & (NamedTree.name == None))
+  if condition is not None:
+    named_trees = named_trees.filter(condition)
+  classifier = Classifier(session, named_trees, "1=1", "1=1")
+  rows = []
+  for p in classifier.packages:
+    package = p.named_tree.package
+    highest_tag = p.highest_tag
+    bugs = [ dict(bug_number=b.bug_number, severity=b.severity, subject=b.subject, forwarded=b.forwarded, tags=b.tags)
+             for b in p.bugs ]
+    rows.append(dict(
+      named_tree_id=p.named_tree.id, team_id=package.repository.team_id,
+      repository_id=package.repository_id, package_id=package.id, name=package.name,
+      highest_tag_id=highest_tag.id if highest_tag is not None else None,
+      archive_version=p.archive_version, bug_list=json.dumps(bugs),
+      ready_for_upload=p.ready_for_upload, has_rc_bugs=p.has_rc_bugs, is_tagged=p.is_tagged,
+      missing_tag=p.missing_tag, todo_bugs=p.todo_bugs, newer_upstream=p.newer_upstream,
+      watch_problem=p.watch_problem, classification=Classifier.classify_package(p)))
+  deleted = session.query(PackageStatus) \
+      .filter(PackageStatus.named_tree_id.in_(named_trees.from_self(NamedTree.id).subquery())) \
+      .delete(False)
+  if rows:
+    columns = sorted(rows[0])
+    session.execute(sqlalchemy.sql.text("INSERT INTO package_status ({columns}) VALUES ({values})".format(
+        columns=", ".join(columns), values=", ".join(":" + c for c in columns))),
+      rows)
+  if rows or deleted:
+    bump_generation(session)
+  print "D: Refreshed the status of {0} packages".format(len(rows))
+
+def bump_generation(session):
+  """mark the data shown by the web interface as changed
+
+  The overview is cached until the data_generation counter changes.
+  """
+  session.execute("UPDATE config SET value = (value::bigint + 1)::text WHERE key = 'data_generation'")
@@ -58,3 +58,6 @@ class DownloadError(WatchException):
 class InvalidVersion(WatchException):
   pass
 
+# archive.py errors.
+class ArchiveException(PetError):
+  pass
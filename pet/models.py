@@ -14,12 +14,18 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import pet
+import collections
+import hashlib
+import json
 import sqlalchemy.dialects.postgresql
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 import sqlalchemy.schema
+import sqlalchemy.sql
 import sqlalchemy.types
 import os.path
+import zlib
 
 
 class DebVersion(sqlalchemy.types.UserDefinedType):
@@ -154,14 +160,71 @@ class Wait(Base):
   __tablename__ = 'wait'
   named_tree = sqlalchemy.orm.relation('NamedTree', backref=sqlalchemy.orm.backref('waits', passive_deletes=True))
 
+class Blob(Base):
+  """contents of files
+
+  Files with identical contents share one `Blob`, identified by the
+  SHA-1 of the UTF-8 encoded contents.  The data is optionally
+  compressed with zlib.
+  """
+  __tablename__ = 'blob'
+  @staticmethod
+  def digest(data):
+    return hashlib.sha1(data).hexdigest()
+  @classmethod
+  def store(cls, session, contents, compression=None):
+    """store `contents` unless they are already known, returns the hash"""
+    data = contents.encode('utf-8')
+    hash = cls.digest(data)
+    size = len(data)
+    # FOR SHARE keeps prune_blobs from removing the blob before the
+    # file referencing it is committed.
+    exists = sqlalchemy.sql.text("SELECT 1 FROM blob WHERE hash = :hash FOR SHARE")
+    if session.execute(exists, dict(hash=hash)).scalar():
+      return hash
+    if compression == 'zlib':
+      compressed = zlib.compress(data, 9)
+      if len(compressed) < len(data):
+        data = compressed
+      else:
+        compression = None
+    elif compression is not None:
+      raise ValueError("unknown compression '{0}'".format(compression))
+    # Several updaters may store the same contents at the same time, the
+    # insert only fails if another one did so first.
+    session.begin_nested()
+    try:
+      session.execute(sqlalchemy.sql.text(
+          "INSERT INTO blob (hash, compression, size, data) VALUES (:hash, :compression, :size, :data)"),
+          dict(hash=hash, compression=compression, size=size, data=buffer(data)))
+      session.commit()
+    except sqlalchemy.exc.IntegrityError:
+      session.rollback()
+    return hash
+  @property
+  def contents(self):
+    data = str(self.data)
+    if self.compression == 'zlib':
+      data = zlib.decompress(data)
+    return unicode(data, 'utf-8')
+
 class File(Base):
   """file retrieved from a VCS
 
-  This class represents a file belonging to a `NamedTree`.
+  This class represents a file belonging to a `NamedTree`.  Its
+  contents are stored in a `Blob`; `contents` is None if the file does
+  not exist.
   """
   __tablename__ = 'file'
   named_tree = sqlalchemy.orm.relation('NamedTree',
       backref=sqlalchemy.orm.backref('files', passive_deletes=True))
+  # Loading contents is expensive, only do so when they are used.
+  blob = sqlalchemy.orm.relation('Blob')
+  @property
+  def contents(self):
+    if self.blob is None:
+      return None
+    return self.blob.contents
 
 class Patch(Base):
   """patches present in debian/patches/series"""
@@ -223,3 +286,30 @@ class BugSource(Base):
   """
   __tablename__ = 'bug_source'
   bug = sqlalchemy.orm.relation('Bug', backref='bug_sources')
+
+StatusBug = collections.namedtuple('StatusBug', 'bug_number severity subject forwarded tags')
+
+class PackageStatus(Base):
+  """classification of a trunk for the overview
+
+  This class holds the result of classifying the trunk `NamedTree` of
+  a package with `pet.classifier.Classifier` together with everything
+  the overview needs besides the named trees and the watch result.
+  Rows are refreshed by the updaters for the packages they touched,
+  see `pet.classifier.refresh_package_status`.
+  """
+  __tablename__ = 'package_status'
+  named_tree = sqlalchemy.orm.relation('NamedTree', foreign_keys='PackageStatus.named_tree_id')
+  highest_tag = sqlalchemy.orm.relation('NamedTree', foreign_keys='PackageStatus.highest_tag_id')
+  source = property(lambda self: self.named_tree.source)
+  version = property(lambda self: self.named_tree.version)
+  last_changed_by = property(lambda self: self.named_tree.last_changed_by)
+  last_changed = property(lambda self: self.named_tree.last_changed)
+  todo = property(lambda self: self.named_tree.todo)
+  watch = property(lambda self: self.named_tree.watch_result)
+  @property
+  def bugs(self):
+    """returns the open bugs as a list of `StatusBug`s"""
+    if '_bugs' not in self.__dict__:
+      self._bugs = [ StatusBug(**b) for b in json.loads(self.bug_list) ]
+    return self._bugs
@@ -28,6 +28,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+from pet.cache import LRUCache
 from pet.exceptions import *
 
 import re
@@ -63,10 +64,31 @@ def compile(pattern):
     pattern = regex.sub(sub, pattern)
   return re.compile(pattern)
 
-def apply_perlre(regexp, string):
+class Substitution(object):
+  """compiled Perl substitution (``s///``)
+
+  Calling the object applies the substitution to a string.  If the
+  expression cannot be used by Python's re module, the string is
+  returned unchanged.
+  """
+  def __init__(self, regex, replacement, count):
+    self.regex = regex
+    self.replacement = replacement
+    self.count = count
+  def __call__(self, string):
+    if self.regex is None:
+      return string
+    try:
+      return self.regex.sub(self.replacement, string, count=self.count)
+    except:
+      return string
+
+_identity = Substitution(None, None, 0)
+
+def _compile_perlre(regexp):
   regexp = regexp.strip()
   if regexp == "":
-    return string
+    return _identity
 
   match_op = _re_op.match(regexp)
   if not match_op:
@@ -134,9 +156,25 @@ def apply_perlre(regexp, string):
   for regex, sub in _replacement_rules:
     replacement = regex.sub(sub, replacement)
 
-  # TODO: flags is only in Python 2.7
   try:
-    return re.sub(pattern, replacement, string, count=count)
+    regex = re.compile(pattern, py_flags)
   except:
-    return string
-  #return re.sub(pattern, replacement, string, count=count, flags=py_flags)
+    regex = None
+  return Substitution(regex, replacement, count)
+
+_substitutions = LRUCache(1024)
+
+def compile_perlre(regexp):
+  """returns a `Substitution` for the Perl expression `regexp`
+
+  Compiled expressions are cached, so this is cheap to call for each
+  version string.
+  """
+  substitution = _substitutions.get(regexp)
+  if substitution is None:
+    substitution = _compile_perlre(regexp)
+    _substitutions[regexp] = substitution
+  return substitution
+
+def apply_perlre(regexp, string):
+  return compile_perlre(regexp)(string)
@@ -19,6 +19,7 @@ SQL helper functions for database maintainance.
 
 from pet.exceptions import *
 
+import hashlib
 import sqlalchemy.sql
 
 class DBUpdate(object):
@@ -365,3 +366,130 @@ DBUpdater().add(15, statements=[
     ADD COLUMN todo BOOLEAN NOT NULL DEFAULT 'f'
   """,
   ])
+
+DBUpdater().add(16, statements=[
+  """
+  ALTER TABLE repository
+    ADD COLUMN rate_limit REAL CHECK (rate_limit > 0),
+    ADD COLUMN rate_burst INT CHECK (rate_burst > 0)
+  """,
+  ])
+
+def _move_file_contents_to_blobs(connection):
+  """store the contents of all files in the blob table"""
+  known = set()
+  updates = []
+  def flush():
+    connection.execute(sqlalchemy.sql.text("UPDATE file SET blob_hash = :hash WHERE id = :id"), updates)
+    del updates[:]
+  rows = connection.execution_options(stream_results=True).execute(
+      "SELECT id, contents FROM file WHERE contents IS NOT NULL")
+  for id, contents in rows:
+    data = contents.encode('utf-8') if isinstance(contents, unicode) else contents
+    hash = hashlib.sha1(data).hexdigest()
+    if hash not in known:
+      connection.execute(
+          sqlalchemy.sql.text("INSERT INTO blob (hash, size, data) VALUES (:hash, :size, :data)"),
+          hash=hash, size=len(data), data=buffer(data))
+      known.add(hash)
+    updates.append(dict(id=id, hash=hash))
+    if len(updates) >= 1000:
+      flush()
+  if updates:
+    flush()
+
+DBUpdater().add(17, statements=[
+  """
+  CREATE TABLE blob (
+    hash TEXT PRIMARY KEY, -- SHA-1 of the uncompressed contents
+    compression TEXT CHECK (compression IN ('zlib')),
+    size INT NOT NULL, -- uncompressed size
+    data BYTEA NOT NULL
+  )""",
+  """
+  ALTER TABLE file
+    ADD COLUMN blob_hash TEXT REFERENCES blob(hash)
+  """,
+  ], callable=_move_file_contents_to_blobs)
+
+DBUpdater().add(18, statements=[
+  "ALTER TABLE file DROP COLUMN contents",
+  "CREATE INDEX ON file (blob_hash)",
+  ])
+
+DBUpdater().add(19, statements=[
+  """
+  ALTER TABLE file
+    ADD COLUMN object_id TEXT -- VCS identifier of the file's contents
+  """,
+  ])
+
+DBUpdater().add(20, statements=[
+  """
+  CREATE TABLE suite_sources (
+    suite_id INT NOT NULL REFERENCES suite(id) ON DELETE CASCADE,
+    component TEXT NOT NULL,
+    sha256 TEXT NOT NULL, -- of the last imported Sources
+    PRIMARY KEY (suite_id, component)
+  )""",
+  ])
+
+DBUpdater().add(21, statements=[
+  # import all Sources again to fill suite_binary
+  "DELETE FROM suite_sources",
+  ])
+
+DBUpdater().add(22, statements=[
+  """
+  ALTER TABLE bug_tracker
+    ADD COLUMN last_modified_watermark TIMESTAMP(0) WITHOUT TIME ZONE,
+    ADD COLUMN last_full_sync TIMESTAMP(0) WITH TIME ZONE
+  """,
+  ])
+
+DBUpdater().add(23, statements=[
+  # BugTrackerUpdater relies on bug numbers being unique per bug tracker
+  """
+  DELETE FROM bug b
+   USING bug o
+   WHERE o.bug_tracker_id = b.bug_tracker_id AND o.bug_number = b.bug_number AND o.id < b.id
+  """,
+  "CREATE UNIQUE INDEX bug_bug_tracker_id_bug_number_key ON bug (bug_tracker_id, bug_number)",
+  ])
+
+DBUpdater().add(24, statements=[
+  # bug (bug_tracker_id, bug_number) is indexed since version 23
+  "CREATE INDEX ON bug_source (source)",
+  "CREATE INDEX ON named_tree (source)",
+  ])
+
+DBUpdater().add(25, statements=[
+  """
+  CREATE TABLE package_status (
+    named_tree_id INT PRIMARY KEY REFERENCES named_tree(id) ON DELETE CASCADE,
+    team_id INT REFERENCES team(id) ON DELETE SET NULL,
+    repository_id INT NOT NULL,
+    package_id INT NOT NULL,
+    name TEXT NOT NULL,
+    highest_tag_id INT REFERENCES named_tree(id) ON DELETE SET NULL,
+    archive_version debversion,
+    bug_list TEXT NOT NULL DEFAULT '[]', -- JSON list of open bugs
+    ready_for_upload BOOLEAN NOT NULL,
+    has_rc_bugs BOOLEAN NOT NULL,
+    is_tagged BOOLEAN NOT NULL,
+    missing_tag BOOLEAN NOT NULL,
+    todo_bugs BOOLEAN NOT NULL,
+    newer_upstream BOOLEAN NOT NULL,
+    watch_problem BOOLEAN NOT NULL,
+    classification TEXT NOT NULL
+  )""",
+  "CREATE INDEX ON package_status (team_id, name)",
+  ])
+
+DBUpdater().add(26, statements=[
+  "INSERT INTO config (key, value) VALUES ('data_generation', '0')",
+  ])
+
+DBUpdater().add(27, statements=[
+  "CREATE INDEX ON named_tree (package_id, type, version DESC)",
+  ])
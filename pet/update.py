@@ -16,19 +16,24 @@
 from pet.exceptions import *
 from pet.models import *
 import pet.vcs
+import pet.archive
 import pet.bts
+import pet.cache
+import pet.classifier
 import pet.watch
 
 import debian
 import debian.changelog
 import debian.deb822
-import os.path
+import Queue
+import datetime
 import re
-import shutil
 import sqlalchemy.orm
 import sqlalchemy.orm.exc
-import subprocess
-import tempfile
+import sqlalchemy.sql
+import sys
+import threading
+import time
 
 re_ignore = re.compile("IGNORE[ -]VERSION:?\s*(?P<version>\S+)", re.IGNORECASE)
 re_waits_for = re.compile(r"""
@@ -41,21 +46,74 @@ re_waits_for = re.compile(r"""
 re_todo = re.compile(r"\A\s*(?:\* )?(?:TODO|PROBLEM|QUESTION):")
 
 class NamedTreeUpdater(object):
-  """update a `pet.models.NamedTree`"""
+  """update a `pet.models.NamedTree`
+
+  `Patch` and `Wait` rows are collected for up to `batch_size` named
+  trees and written together; call `flush` after the last named tree.
+  """
+  # files retrieved for each named tree
+  filenames = ("debian/patches/series", "debian/control", "debian/changelog", "debian/watch")
+  batch_size = 500
+  def __init__(self):
+    self.session = None
+    # named trees whose patches/waits are replaced, and the new rows
+    self._patch_trees = []
+    self._patches = []
+    self._wait_trees = []
+    self._waits = []
+  def flush(self):
+    """write collected `Patch` and `Wait` rows to the database"""
+    for model, trees, rows in ((Patch, self._patch_trees, self._patches), (Wait, self._wait_trees, self._waits)):
+      table = model.__table__
+      if trees:
+        self.session.execute(table.delete().where(table.c.named_tree_id.in_(trees)))
+      if rows:
+        self.session.execute(table.insert(), rows)
+      del trees[:]
+      del rows[:]
+  def carry_forward(self):
+    """
+    move files that did not change since the last update to the current
+    commit, so they are neither retrieved nor parsed again
+    """
+    if not self.object_ids:
+      return
+    old_files = self.session.query(File).filter((File.named_tree == self.named_tree) & (File.commit_id != self.named_tree.commit_id))
+    for f in old_files:
+      if f.name not in self.object_ids or self.object_ids[f.name] != f.object_id:
+        continue
+      # Files stored without object id can only be carried forward
+      # if they did not exist and still do not exist.
+      if f.object_id is None and f.blob_hash is not None:
+        continue
+      f.commit_id = self.named_tree.commit_id
+    self.session.flush()
   def delete_old_files(self):
     """remove all outdated versions of files for this named tree"""
     self.session.query(File).filter((File.named_tree == self.named_tree) & (File.commit_id != self.named_tree.commit_id)).delete()
+  def _tree(self):
+    """returns the keyword arguments selecting the named tree in the VCS"""
+    if self.named_tree.type == 'tag':
+      return dict(tag=self.named_tree.name)
+    elif self.named_tree.type == 'branch':
+      return dict(branch=self.named_tree.name)
+    else:
+      raise ValueError("unknown NamedTree type '{0}'".format(self.named_tree.type))
+  def prefetch(self):
+    """retrieve all files not stored for the current commit in one request"""
+    stored = set([ f[0] for f in self.session.query(File.name).filter_by(named_tree=self.named_tree, commit_id=self.named_tree.commit_id) ])
+    missing = [ f for f in self.filenames if f not in stored ]
+    if missing:
+      self._prefetched = self.vcs.files(self.package.name, missing, **self._tree())
   def _get(self, filename):
     """
     get contents of a file for the current named tree as a string,
     or None if the file does not exist
     """
-    if self.named_tree.type == 'tag':
-      contents = self.vcs.file(self.package.name, filename, tag=self.named_tree.name)
-    elif self.named_tree.type == 'branch':
-      contents = self.vcs.file(self.package.name, filename, branch=self.named_tree.name)
+    if filename in self._prefetched:
+      contents = self._prefetched.pop(filename)
     else:
-      raise ValueError("unknown NamedTree type '{0}'".format(self.named_tree.type))
+      contents = self.vcs.file(self.package.name, filename, **self._tree())
 
     if contents is not None:
       try:
@@ -66,42 +124,48 @@ class NamedTreeUpdater(object):
   def file(self, filename):
     """retrieve the named file from the VCS and store it in the database.
 
-    Returns a tuple (file, changed) with file a `pet.models.File`
-    object and changed a Boolean indicating that the file was
-    updated.
+    Returns a tuple (contents, changed) with contents the file's
+    contents (None if it does not exist) and changed a Boolean
+    indicating that the file was updated.  The contents of an unchanged
+    file are only loaded when updating with force; they are None
+    otherwise.
     """
     try:
       f = self.named_tree.file(filename)
+      contents = f.contents if self.force else None
       changed = False
     except sqlalchemy.orm.exc.NoResultFound:
       try:
         contents = self._get(filename)
       except FileNotFound:
         contents = None
-      f = File(named_tree=self.named_tree, commit_id=self.named_tree.commit_id, name=filename, contents=contents)
+      blob_hash = None
+      if contents is not None:
+        blob_hash = Blob.store(self.session, contents, compression=self.compression)
+      f = File(named_tree=self.named_tree, commit_id=self.named_tree.commit_id, name=filename, blob_hash=blob_hash,
+          object_id=self.object_ids.get(filename))
       self.session.add(f)
       changed = True
-    return f, changed
+    return contents, changed
   def update_patches(self):
     """update list of patches for named tree"""
-    patches, changed = self.file("debian/patches/series")
+    series, changed = self.file("debian/patches/series")
     if not changed and not self.force: return
-    self.session.query(Patch).filter_by(named_tree=self.named_tree).delete()
-    if patches.contents:
-      for line in patches.contents.splitlines():
+    self._patch_trees.append(self.named_tree.id)
+    if series:
+      for line in series.splitlines():
         if line.startswith("#"):
           continue
         fields = line.split()
         if len(fields):
-          patch = Patch(named_tree=self.named_tree, name=fields[0])
-          self.session.add(patch)
+          self._patches.append(dict(named_tree_id=self.named_tree.id, name=fields[0]))
   def update_control(self):
     """update information extracted from debian/control"""
-    control_file, changed = self.file("debian/control")
+    control_contents, changed = self.file("debian/control")
     if not changed and not self.force: return
     nt = self.named_tree
-    if control_file.contents:
-      control = debian.deb822.Deb822(control_file.contents)
+    if control_contents:
+      control = debian.deb822.Deb822(control_contents)
       nt.source = control.get("Source")
       if "Maintainer" in control:
         nt.maintainer = control["Maintainer"].strip()
@@ -119,14 +183,14 @@ class NamedTreeUpdater(object):
       nt.source = nt.maintainer = nt.uploaders = nt.homepage = None
   def update_changelog(self):
     """update information extracted from debian/changelog"""
-    changelog_file, changed = self.file("debian/changelog")
+    changelog_contents, changed = self.file("debian/changelog")
     if not changed and not self.force: return
     nt = self.named_tree
     nt.ignore = nt.todo = False
-    self.session.query(Wait).filter_by(named_tree=self.named_tree).delete()
+    self._wait_trees.append(self.named_tree.id)
 
-    if changelog_file.contents:
-      changelog = debian.changelog.Changelog(changelog_file.contents,
+    if changelog_contents:
+      changelog = debian.changelog.Changelog(changelog_contents,
           strict=False)
       nt.source_changelog = changelog.package
       nt.version = str(changelog.version)
@@ -144,8 +208,7 @@ class NamedTreeUpdater(object):
 
         match = re_waits_for.search(line)
         if match:
-          wait = Wait(named_tree=self.named_tree, name=match.group('package'), version=match.group('version'), comment=match.group('comment'))
-          self.session.add(wait)
+          self._waits.append(dict(named_tree_id=self.named_tree.id, name=match.group('package'), version=match.group('version'), comment=match.group('comment')))
 
         if re_todo.search(line):
           nt.todo = True
@@ -154,21 +217,38 @@ class NamedTreeUpdater(object):
       nt.versions = []
   def update_watch(self):
     """update cached version of debian/watch"""
-    watch_file, changed = self.file("debian/watch")
+    watch_contents, changed = self.file("debian/watch")
   def run(self, named_tree, package, vcs, force=False):
-    self.session = Session.object_session(named_tree)
+    session = Session.object_session(named_tree)
+    if session is not self.session and self.session is not None:
+      self.flush()
+    self.session = session
     self.named_tree = named_tree
+    if named_tree.id is None:
+      # patches and waits are collected by named tree id
+      self.session.flush()
     self.package = package
     self.vcs = vcs
     self.force = force
+    self._prefetched = {}
+    # compression for new blobs: None or 'zlib'
+    self.compression = self.session.query(Config.value).filter_by(key='blob_compression').scalar()
 
     print "I: updating {0}, {1} {2}".format(self.package.name, self.named_tree.type, self.named_tree.name)
 
+    self.object_ids = self.vcs.object_ids(self.package.name, self.filenames, **self._tree()) or {}
+    self.carry_forward()
     self.delete_old_files()
+    self.prefetch()
     self.update_patches()
     self.update_control()
     self.update_changelog()
     self.update_watch()
+    if max(len(self._patch_trees), len(self._wait_trees)) >= self.batch_size:
+      self.flush()
+
+def _is_trunk(named_tree):
+  return named_tree.type == 'branch' and named_tree.name is None
 
 class PackageUpdater(object):
   """update a `pet.models.Package`"""
@@ -178,6 +258,9 @@ class PackageUpdater(object):
     for name, nt in known.iteritems():
       commit_id = existing.get(name, None)
       if commit_id is None:
+        # its PackageStatus goes away with the trunk
+        if _is_trunk(nt):
+          pet.classifier.bump_generation(self.session)
         self.session.delete(nt)
       else:
         nt.commit_id = str(commit_id)
@@ -202,6 +285,7 @@ class PackageUpdater(object):
     ntu = NamedTreeUpdater()
     for nt in self.package.named_trees:
       ntu.run(nt, self.package, self.vcs, force=self.force)
+    ntu.flush()
   def run(self, package, vcs, force=False):
     self.session = Session.object_session(package)
     self.package = package
@@ -213,12 +297,19 @@ class PackageUpdater(object):
     self.update_named_trees()
 
 class RepositoryUpdater(object):
-  """update a `pet.models.Repository`"""
-  def __init__(self, repository, force=False):
+  """update a `pet.models.Repository`
+
+  With `jobs` > 1 packages are updated by that many worker threads, see
+  `update_packages_parallel`.
+  """
+  def __init__(self, repository, force=False, jobs=1):
     self.session = Session.object_session(repository)
     self.repository = repository
     self.vcs = pet.vcs.vcs_backend(repository)
     self.force = force
+    self.jobs = jobs
+    # ids of packages with changed named trees
+    self.touched = set()
   def update_package_list(self):
     self.session.begin_nested()
     try:
@@ -227,9 +318,14 @@ class RepositoryUpdater(object):
         known_packages[p.name] = p
       existing_packages = self.vcs.packages
 
+      deleted = False
       for name, p in known_packages.iteritems():
         if name not in existing_packages:
           self.session.delete(p)
+          deleted = True
+      # The overview must no longer list deleted packages.
+      if deleted:
+        pet.classifier.bump_generation(self.session)
       for name in existing_packages:
         if name not in known_packages:
           package = Package(name=name, repository=self.repository)
@@ -247,13 +343,23 @@ class RepositoryUpdater(object):
       for nt in self.session.query(NamedTree).join(NamedTree.package).filter(Package.repository==self.repository):
         named_trees_by_package[nt.package].append(nt)
       print "D: Looking for changes in {0} packages.".format(len(named_trees_by_package))
+      known = [ nt for nts in named_trees_by_package.itervalues() for nt in nts ]
       changed = self.vcs.changed_named_trees(self.session, named_trees_by_package)
       print "D: Found {0} changed packages.".format(len(changed))
+      # Deleting a named tree, e.g. the highest tag, changes the status too.
+      self.session.flush()
+      remaining = set(id for (id,) in self.session.query(NamedTree.id).join(NamedTree.package).filter(Package.repository==self.repository))
+      deleted = [ nt for nt in known if nt.id not in remaining ]
+      self.touched.update(nt.package_id for nt in deleted)
+      if any(_is_trunk(nt) for nt in deleted):
+        pet.classifier.bump_generation(self.session)
 
       ntu = NamedTreeUpdater()
       for p, nts in changed.iteritems():
         for nt in nts:
           ntu.run(nt, p, self.vcs)
+        self.touched.add(p.id)
+      ntu.flush()
       self.session.commit()
     except:
       self.session.rollback()
@@ -273,137 +379,644 @@ class RepositoryUpdater(object):
       except:
         self.session.rollback()
         raise
-  def run(self):
-    self.update_package_list()
+  def _update_package(self, session, vcs, package):
+    """update a single package
+
+    Returns the number of updated or deleted named trees.
+    """
     if self.force:
-      self.update_all_packages()
+      PackageUpdater().run(package, vcs, force=True)
+      return len(package.named_trees)
+    named_trees = session.query(NamedTree).filter_by(package_id=package.id).all()
+    changed = vcs.changed_named_trees(session, {package: named_trees}).get(package, [])
+    session.flush()
+    remaining = set(id for (id,) in session.query(NamedTree.id).filter_by(package_id=package.id))
+    deleted = [ nt for nt in named_trees if nt.id not in remaining ]
+    if any(_is_trunk(nt) for nt in deleted):
+      pet.classifier.bump_generation(session)
+    ntu = NamedTreeUpdater()
+    for nt in changed:
+      ntu.run(nt, package, vcs)
+    if changed:
+      ntu.flush()
+    return len(changed) + len(deleted)
+  def update_packages_parallel(self):
+    """update all packages in `jobs` worker threads
+
+    Each worker has its own session and VCS backend and commits after
+    every package, so an error only affects the package it occurred in.
+    """
+    # Workers must see the package list and must not wait for our locks.
+    self.session.commit()
+    tasks = Queue.Queue()
+    packages = self.session.query(Package.id, Package.name).filter_by(repository_id=self.repository.id).order_by(Package.name).all()
+    for package_id, name in packages:
+      tasks.put((package_id, name))
+    results = Queue.Queue()
+
+    def worker(session, vcs):
+      try:
+        while True:
+          try:
+            package_id, name = tasks.get_nowait()
+          except Queue.Empty:
+            return
+          start = time.time()
+          try:
+            updated = self._update_package(session, vcs, session.query(Package).get(package_id))
+            session.commit()
+            error = None
+          except Exception as e:
+            session.rollback()
+            updated, error = 0, e
+          results.put((package_id, name, updated, time.time() - start, error))
+      finally:
+        vcs.close()
+        session.close()
+
+    start = time.time()
+    for n in range(min(self.jobs, len(packages))):
+      session = Session()
+      vcs = pet.vcs.vcs_backend(session.query(Repository).get(self.repository.id))
+      thread = threading.Thread(target=worker, args=(session, vcs))
+      thread.daemon = True
+      thread.start()
+
+    timings = []
+    failed = 0
+    for n in range(len(packages)):
+      # Queue.get only reacts to KeyboardInterrupt when given a timeout.
+      package_id, name, updated, elapsed, error = results.get(True, 86400)
+      if updated:
+        self.touched.add(package_id)
+      if error is not None:
+        print "E: error while updating package {0}: {1}".format(name, error)
+        failed += 1
+      if updated or error is not None:
+        timings.append((elapsed, name))
+    print "I: Updated {0} packages in {1:.1f}s ({2} jobs, {3} failed)".format(len(timings), time.time() - start, self.jobs, failed)
+    for elapsed, name in sorted(timings, reverse=True):
+      print "D: {0:8.1f}s {1}".format(elapsed, name)
+  def refresh_status(self):
+    """refresh the `PackageStatus` of updated packages"""
+    if self.force:
+      condition = NamedTree.package_id.in_(self.session.query(Package.id).filter_by(repository_id=self.repository.id).subquery())
+    elif self.touched:
+      condition = NamedTree.package_id.in_(list(self.touched))
     else:
-      self.update_changed_packages()
+      return
+    pet.classifier.refresh_package_status(self.session, condition)
+  def run(self):
+    try:
+      self.update_package_list()
+      if self.jobs > 1:
+        self.update_packages_parallel()
+      elif self.force:
+        self.update_all_packages()
+      else:
+        self.update_changed_packages()
+      self.refresh_status()
+    finally:
+      self.vcs.close()
+
+def prune_blobs(session):
+  """remove blobs no longer used by any file
+
+  The blob table is locked until the transaction ends, so updaters
+  storing files wait for the deletion to be committed.
+  """
+  session.execute("LOCK TABLE blob IN EXCLUSIVE MODE")
+  deleted = session.execute("DELETE FROM blob WHERE NOT EXISTS (SELECT 1 FROM file WHERE file.blob_hash = blob.hash)").rowcount
+  print "I: Deleted {0} unreferenced blobs".format(deleted)
+
+def _refresh_status(session, sources):
+  """refresh the `PackageStatus` of the trunks of `sources`"""
+  if not sources:
+    return
+  if len(sources) > 1000:
+    pet.classifier.refresh_package_status(session)
+  else:
+    pet.classifier.refresh_package_status(session, NamedTree.source.in_(list(sources)))
+
+def _copy_value(value):
+  """format `value` for PostgreSQL's COPY text format"""
+  if value is None:
+    return "\\N"
+  if isinstance(value, bool):
+    value = 't' if value else 'f'
+  elif isinstance(value, (int, long)):
+    value = str(value)
+  elif isinstance(value, datetime.datetime):
+    value = value.isoformat(' ')
+  elif isinstance(value, (list, tuple)):
+    value = _array_literal([ v if isinstance(v, basestring) else str(v) for v in value ])
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _array_literal(values):
+  """format `values` as a PostgreSQL array literal"""
+  return "{" + ",".join('"' + v.replace("\\", "\\\\").replace('"', '\\"') + '"' for v in values) + "}"
+
+def _copy_rows(session, table, columns, rows):
+  """load `rows`, tuples of values for `columns`, into `table` with COPY"""
+  lines = ( "\t".join(_copy_value(v) for v in row) + "\n" for row in rows )
+  cursor = session.connection().connection.cursor()
+  try:
+    cursor.copy_expert("COPY {0} ({1}) FROM STDIN".format(table, ", ".join(columns)), _CopyStream(lines))
+  finally:
+    cursor.close()
+
+class _CopyStream(object):
+  """file-like object reading the lines produced by an iterator, for COPY"""
+  def __init__(self, lines):
+    self._lines = lines
+    self._buffer = ""
+  def read(self, size=-1):
+    while size < 0 or len(self._buffer) < size:
+      try:
+        self._buffer += next(self._lines)
+      except StopIteration:
+        break
+    if size < 0:
+      size = len(self._buffer)
+    data, self._buffer = self._buffer[:size], self._buffer[size:]
+    return data
+  def readline(self, size=-1):
+    return self.read(size)
 
 class SuiteUpdater(object):
-  def __init__(self, suite, archive, tmpdir=None):
+  """update the list of source packages in a `pet.models.Suite`
+
+  Only components whose Sources changed according to the suite's
+  Release file are imported.  Sources are streamed into a temporary
+  table with COPY and then merged into suite_package with set-based
+  statements, so rows of unchanged packages are kept.  If the last
+  imported Sources could be updated with pdiffs, only the paragraphs
+  that changed are loaded.  The binary packages from the Binary field
+  are kept in suite_binary the same way.
+
+  `cache` is a `pet.cache.PageCache` used for the Release file;
+  `cache_directory` keeps the last copy of each Sources file.  Requests
+  to the mirror time out after `timeout` seconds.
+  """
+  def __init__(self, suite, archive, cache=None, cache_directory=None, force=False, timeout=pet.archive.TIMEOUT):
     self.session = Session.object_session(suite)
     self.suite = suite
     self.archive = archive
-    if tmpdir:
-      self.tmpdir = tmpdir
-      self.cleantmp = False
+    self.cache = cache
+    self.cache_directory = cache_directory
+    self.force = force
+    self.timeout = timeout
+    # sources whose versions in the suite changed
+    self.touched = set()
+  def _row(self, component, s):
+    """returns the suite_package columns for the Sources paragraph `s`"""
+    if "Uploaders" in s:
+      uploaders = _array_literal([ u.strip() for u in s["Uploaders"].split(",") ])
+    else:
+      uploaders = None
+    binaries = _array_literal(sorted(set( b.strip() for b in s.get("Binary", "").split(",") if b.strip() )))
+    return (s["Package"], s["Version"], component, s["Maintainer"].strip(), uploaders,
+            "{0}/{1}_{2}.dsc".format(s["Directory"], s["Package"], s["Version"]), binaries)
+  def _copy(self, rows):
+    """load `rows` into suite_package_new"""
+    self.session.execute("""
+      CREATE TEMPORARY TABLE IF NOT EXISTS suite_package_new (
+        source TEXT NOT NULL,
+        version debversion NOT NULL,
+        component TEXT NOT NULL,
+        maintainer TEXT NOT NULL,
+        uploaders TEXT,
+        dsc TEXT NOT NULL,
+        binaries TEXT[] NOT NULL
+      ) ON COMMIT DROP""")
+    self.session.execute("TRUNCATE suite_package_new")
+    _copy_rows(self.session, "suite_package_new",
+        ("source", "version", "component", "maintainer", "uploaders", "dsc", "binaries"), rows)
+  def merge_package_list(self, component, removed=None):
+    """make suite_package match suite_package_new for `component`
+
+    If `removed` is None, suite_package_new holds all packages of the
+    component and packages missing from it are removed.  Otherwise it
+    only holds new or changed packages and `removed` lists the
+    (source, version) pairs to remove.
+    """
+    params = dict(suite_id=self.suite.id, component=component)
+    if removed is None:
+      deleted = self.session.execute("""
+        DELETE FROM suite_package sp
+         WHERE sp.suite_id = :suite_id AND sp.component = :component
+           AND NOT EXISTS (SELECT 1 FROM suite_package_new n
+                            WHERE n.component = sp.component AND n.source = sp.source AND n.version = sp.version)
+        RETURNING sp.source""",
+        params).fetchall()
+      self.touched.update(row[0] for row in deleted)
+      deleted = len(deleted)
+    else:
+      deleted = len(removed)
+      self.touched.update(source for source, version in removed)
+      if removed:
+        self.session.execute(sqlalchemy.sql.text("""
+          DELETE FROM suite_package
+           WHERE suite_id = :suite_id AND component = :component AND source = :source AND version = :version"""),
+          [ dict(params, source=source, version=version) for source, version in removed ])
+    updated = self.session.execute("""
+      UPDATE suite_package sp
+         SET maintainer = n.maintainer, uploaders = n.uploaders, dsc = n.dsc
+        FROM suite_package_new n
+       WHERE sp.suite_id = :suite_id
+         AND n.component = sp.component AND n.source = sp.source AND n.version = sp.version
+         AND (sp.maintainer, sp.uploaders, sp.dsc) IS DISTINCT FROM (n.maintainer, n.uploaders, n.dsc)""",
+      params).rowcount
+    inserted = self.session.execute("""
+      INSERT INTO suite_package (suite_id, source, version, component, maintainer, uploaders, dsc)
+      SELECT DISTINCT ON (n.component, n.source, n.version)
+             :suite_id, n.source, n.version, n.component, n.maintainer, n.uploaders, n.dsc
+        FROM suite_package_new n
+       WHERE NOT EXISTS (SELECT 1 FROM suite_package sp
+                          WHERE sp.suite_id = :suite_id
+                            AND sp.component = n.component AND sp.source = n.source AND sp.version = n.version)
+      RETURNING source""",
+      params).fetchall()
+    self.touched.update(row[0] for row in inserted)
+    inserted = len(inserted)
+    self.merge_binaries(component)
+    print "I: Suite {0}/{1}: {2} new, {3} changed, {4} removed source packages".format(self.suite.name, component, inserted, updated, deleted)
+  def merge_binaries(self, component):
+    """make suite_binary match the binaries of the packages in suite_package_new"""
+    params = dict(suite_id=self.suite.id, component=component)
+    self.session.execute("""
+      DELETE FROM suite_binary sb
+       USING suite_package sp, suite_package_new n
+       WHERE sb.source_id = sp.id
+         AND sp.suite_id = :suite_id AND sp.component = :component
+         AND n.component = sp.component AND n.source = sp.source AND n.version = sp.version
+         AND NOT sb.name = ANY(n.binaries)""", params)
+    self.session.execute("""
+      INSERT INTO suite_binary (source_id, name)
+      SELECT DISTINCT sp.id, b.name
+        FROM suite_package_new n
+        JOIN suite_package sp
+          ON sp.suite_id = :suite_id AND sp.component = n.component AND sp.source = n.source AND sp.version = n.version
+       CROSS JOIN unnest(n.binaries) AS b(name)
+       WHERE NOT EXISTS (SELECT 1 FROM suite_binary sb WHERE sb.source_id = sp.id AND sb.name = b.name)""", params)
+  def update_component(self, component, known):
+    """import Sources of `component`, last imported with hash `known`"""
+    name = "{0}/source/Sources".format(component)
+    patched = None
+    if known is not None and not self.force:
+      patched = self.reader.patched(name, known)
+    if patched is None:
+      print "D: Importing Sources for {0}/{1}".format(self.suite.name, component)
+      self._copy(self._row(component, p) for p in self.reader.paragraphs(self.reader.lines(name)))
+      self.merge_package_list(component)
     else:
-      self.tmpdir = tempfile.mkdtemp(prefix="pet-suite-{0}".format(self.suite.name))
-      self.cleantmp = True
-  def __del__(self):
-    if self.cleantmp:
-      shutil.rmtree(self.tmpdir)
-  def delete_package_list(self):
-    self.session.query(SuitePackage).filter_by(suite=self.suite).delete()
-  def _download(self, source, target):
-    target_xz = target + ".xz"
-    r = subprocess.call(['wget', '--quiet', '-O', target_xz, '--', source])
-    if r:
-      raise IOError("wget failed for {0}.".format(source))
-    with open(target, 'w') as fh:
-      r = subprocess.call(['xz', '--decompress', '--stdout', '--', target_xz], stdout=fh)
-      if r:
-        raise IOError("xz failed for {0}.".format(source))
-  def add_package_list(self):
+      old, new = patched
+      old_rows = set(self._row(component, p) for p in self.reader.paragraphs(old))
+      new_rows = set(self._row(component, p) for p in self.reader.paragraphs(new))
+      added = new_rows - old_rows
+      kept = set((row[0], row[1]) for row in new_rows)
+      removed = set((row[0], row[1]) for row in old_rows - new_rows) - kept
+      self._copy(added)
+      self.merge_package_list(component, removed)
+  def changed_components(self):
+    """returns a dict mapping changed components to a tuple (known hash, new hash)"""
+    known = dict(self.session.execute(
+        "SELECT component, sha256 FROM suite_sources WHERE suite_id = :suite_id",
+        dict(suite_id=self.suite.id)).fetchall())
+    changed = {}
     for component in self.suite.components:
-      url = "{0}/dists/{1}/{2}/source/Sources.xz".format(self.archive.url, self.suite.name, component)
-      target = os.path.join(self.tmpdir, "sources-{0}-{1}-{2}".format(self.archive.id, self.suite.id, component))
-      self._download(url, target)
-      with open(target, 'r') as fh:
-        for s in debian.deb822.Sources.iter_paragraphs(fh):
-          if "Uploaders" in s:
-            uploaders = [ u.strip() for u in s["Uploaders"].split(",") ]
-          else:
-            uploaders = None
-          sp = SuitePackage(
-            suite      = self.suite,
-            source     = s["Package"],
-            version    = s["Version"],
-            component  = component,
-            maintainer = s["Maintainer"].strip(),
-            uploaders  = uploaders,
-            dsc        = "{0}/{1}_{2}.dsc".format(s["Directory"], s["Package"], s["Version"]),
-            )
-          self.session.add(sp)
+      name = "{0}/source/Sources".format(component)
+      sha256 = self.release.hash(name)
+      if sha256 is None:
+        index = self.release.index(name)
+        sha256 = index.sha256 if index is not None else None
+      if sha256 is None:
+        print "E: Suite {0} has no Sources for {1}".format(self.suite.name, component)
+      elif self.force or known.get(component) != sha256:
+        changed[component] = (known.get(component), sha256)
+    return changed
+  def _store_hash(self, component, sha256):
+    params = dict(suite_id=self.suite.id, component=component, sha256=sha256)
+    self.session.execute("DELETE FROM suite_sources WHERE suite_id = :suite_id AND component = :component", params)
+    self.session.execute("INSERT INTO suite_sources (suite_id, component, sha256) VALUES (:suite_id, :component, :sha256)", params)
   def run(self):
+    self.release = pet.archive.Release(self.archive.url, self.suite.name, cache=self.cache, timeout=self.timeout)
+    self.reader = pet.archive.IndexReader(self.release, self.cache_directory)
+    changed = self.changed_components()
+    if not changed:
+      print "I: Suite {0} is unchanged".format(self.suite.name)
+      return
     self.session.begin_nested()
     try:
-      self.delete_package_list()
-      self.add_package_list()
+      for component, (known, sha256) in sorted(changed.iteritems()):
+        self.update_component(component, known)
+        self._store_hash(component, sha256)
+      _refresh_status(self.session, self.touched)
       self.session.commit()
     except:
       self.session.rollback()
       raise
 
 class ArchiveUpdater(object):
-  def __init__(self, archive):
+  def __init__(self, archive, cache_directory=None, force=False, timeout=pet.archive.TIMEOUT):
     self.archive = archive
+    self.cache_directory = cache_directory
+    self.force = force
+    self.timeout = timeout
   def run(self):
+    # Release files are always revalidated with a conditional request.
+    cache = pet.cache.PageCache(self.cache_directory, ttl=0)
     for suite in self.archive.suites:
-      su = SuiteUpdater(suite, self.archive)
+      su = SuiteUpdater(suite, self.archive, cache=cache, cache_directory=self.cache_directory, force=self.force, timeout=self.timeout)
       su.run()
 
 class BugTrackerUpdater(object):
-  def __init__(self, bug_tracker):
+  """update bug reports from a bug tracker
+
+  A full sync asks for the status of every known bug and every bug of
+  the team's source packages.  Otherwise only new bugs, open bugs that
+  no longer belong to the sources and bugs reported as changed since the
+  tracker's last_modified_watermark by the change feed configured in
+  `bts_change_feed` (the database URL of an UDD mirror) are fetched.  A
+  full sync is done when `full` is true, or if `full` is None when the
+  last one is older than `bts_full_sync_interval` hours (default 24).
+  Without a change feed, or before the first full sync set the
+  watermark, every sync is a full one.
+
+  Bug reports are fetched in batches of `batch_size` bugs by `jobs`
+  concurrent requests and written while later batches are in flight.
+  """
+  # The change feed is updated less often than the bug tracker.
+  feed_overlap = datetime.timedelta(hours=6)
+  def __init__(self, bug_tracker, full=None, jobs=4, batch_size=500):
     self.session = Session.object_session(bug_tracker)
     self.bug_tracker = bug_tracker
-  def _delete_unreferenced_bugs(self, sources):
-    # TODO: Should use SQL to look for source package names in named_trees.
-    print self.session.query(Bug).join(Bug.bug_sources) \
-        .filter((Bug.bug_tracker==self.bug_tracker) & ~ BugSource.source.in_(sources)) \
-        .statement
+    self.full = full
+    self.jobs = jobs
+    self.batch_size = batch_size
+    # sources whose bugs changed
+    self.touched = set()
+  def binary_source_map(self):
+    """returns a dict mapping binary package names to a tuple of their source packages"""
+    result = {}
+    sources = {}
+    query = self.session.query(SuiteBinary.name, SuitePackage.source) \
+        .join(SuiteBinary.source).distinct()
+    for binary, source in query:
+      # There are far fewer source names than binaries, share them.
+      source = sources.setdefault(source, source)
+      result[binary] = result.get(binary, ()) + (source,)
+    return result
+  def _config(self, key):
+    return self.session.query(Config.value).filter_by(key=key).scalar()
+  def full_sync_due(self):
+    interval = self._config('bts_full_sync_interval')
+    return self.session.execute(sqlalchemy.sql.text("""
+      SELECT last_full_sync IS NULL OR last_full_sync < now() - :hours * interval '1 hour'
+        FROM bug_tracker WHERE id = :id"""),
+      dict(id=self.bug_tracker.id, hours=float(interval or 24))).scalar()
+  def changed_bugs(self, bts, sources):
+    """returns the numbers of bugs whose status has to be fetched"""
+    known = set()
+    done = set()
+    for bug_number, bug_done in self.session.query(Bug.bug_number, Bug.done).filter_by(bug_tracker=self.bug_tracker):
+      known.add(bug_number)
+      if bug_done:
+        done.add(bug_number)
+    current = bts.bug_numbers(sources)
+    # Bugs that are done are eventually archived and then no longer
+    # belong to the sources, there is no need to fetch them every time.
+    changed = (current - known) | (known - current - done)
+    feed = pet.bts.UDDChangeFeed(self._config('bts_change_feed'))
+    watermark = self.bug_tracker.last_modified_watermark
+    changed |= feed.changed(sources, watermark - self.feed_overlap) & (current | known)
+    print "I: {0} of {1} bugs may have changed".format(len(changed), len(current | known))
+    return changed
+  def _store_watermark(self, full):
+    self.bug_tracker.last_modified_watermark = self.session.query(sqlalchemy.sql.func.max(Bug.last_modified)) \
+        .filter_by(bug_tracker=self.bug_tracker).scalar()
+    if full:
+      self.bug_tracker.last_full_sync = sqlalchemy.sql.func.now()
+  def _delete_unreferenced_bugs(self):
+    """delete bugs that do not affect a source package of any named tree"""
+    deleted = self.session.execute("""
+      DELETE FROM bug b
+       WHERE b.bug_tracker_id = :bug_tracker_id
+         AND NOT EXISTS (SELECT 1 FROM bug_source bs
+                           JOIN named_tree nt ON nt.source = bs.source
+                          WHERE bs.bug_id = b.id)""",
+      dict(bug_tracker_id=self.bug_tracker.id)).rowcount
+    print "I: Deleted {0} unreferenced bugs".format(deleted)
   def _update_bugs(self, bug_reports):
-    bugs = {}
-    for bug in self.session.query(Bug).filter_by(bug_tracker=self.bug_tracker):
-      bugs[bug.bug_number] = bug
-
-    print "I: Updating {0} bug reports...".format(len(bug_reports))
-    progress = 0
-    for br in bug_reports:
-      # TODO: one query per bug is SLOOOOOW!
-      try:
-        bug = bugs[br.bug_number]
-      except KeyError:
-        bug = Bug(bug_tracker=self.bug_tracker, bug_number=br.bug_number)
-        self.session.add(bug)
-      br.update_bug(bug)
+    """store `bug_reports`
 
-      progress += 1
-      if progress % 10 == 0:
-        print "D:   {0} / {1} done".format(progress, len(bug_reports))
+    The reports are loaded into temporary tables with COPY and merged
+    into bug and bug_source with a fixed number of statements.
+    """
+    self.session.execute("""
+      CREATE TEMPORARY TABLE IF NOT EXISTS bug_new (
+        bug_number INT NOT NULL,
+        done BOOLEAN NOT NULL,
+        severity TEXT NOT NULL,
+        tags TEXT[] NOT NULL,
+        subject TEXT NOT NULL,
+        submitter TEXT NOT NULL,
+        created TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+        owner TEXT NOT NULL,
+        forwarded TEXT,
+        blocks INT[] NOT NULL,
+        blocked_by INT[] NOT NULL,
+        last_modified TIMESTAMP(0) WITHOUT TIME ZONE
+      ) ON COMMIT DROP""")
+    self.session.execute("""
+      CREATE TEMPORARY TABLE IF NOT EXISTS bug_source_new (
+        bug_number INT NOT NULL,
+        source TEXT NOT NULL,
+        fixed_versions TEXT[] NOT NULL,
+        found_versions TEXT[] NOT NULL
+      ) ON COMMIT DROP""")
+    self.session.execute("TRUNCATE bug_new, bug_source_new")
+
+    print "I: Updating bug reports..."
+    bug_sources = []
+    def rows():
+      for br in bug_reports:
+        bug_sources.extend(br.bug_source_rows())
+        yield br.bug_row()
+    _copy_rows(self.session, "bug_new", pet.bts.bug_columns, rows())
+    _copy_rows(self.session, "bug_source_new", ("bug_number", "source", "fixed_versions", "found_versions"), bug_sources)
+
+    params = dict(bug_tracker_id=self.bug_tracker.id)
+    columns = [ c for c in pet.bts.bug_columns if c != 'bug_number' ]
+    values = [ "n.severity::severity" if c == 'severity' else "n." + c for c in columns ]
+    # Updaters of the same bug tracker must not insert the same bugs
+    # concurrently: serialize them on the bug tracker row.
+    self.session.execute("SELECT 1 FROM bug_tracker WHERE id = :bug_tracker_id FOR UPDATE", params)
+    updated = self.session.execute("""
+      UPDATE bug b
+         SET ({columns}) = ({values})
+        FROM (SELECT DISTINCT ON (bug_number) * FROM bug_new) n
+       WHERE b.bug_tracker_id = :bug_tracker_id AND b.bug_number = n.bug_number
+         AND ({current}) IS DISTINCT FROM ({values})
+      RETURNING b.bug_number""".format(
+          columns=", ".join(columns), values=", ".join(values),
+          current=", ".join("b." + c for c in columns)),
+      params).fetchall()
+    inserted = self.session.execute("""
+      INSERT INTO bug (bug_tracker_id, bug_number, {columns})
+      SELECT DISTINCT ON (n.bug_number) :bug_tracker_id, n.bug_number, {values}
+        FROM bug_new n
+       WHERE NOT EXISTS (SELECT 1 FROM bug b WHERE b.bug_tracker_id = :bug_tracker_id AND b.bug_number = n.bug_number)
+      RETURNING bug_number""".format(
+          columns=", ".join(columns), values=", ".join(values)),
+      params).fetchall()
+    changed = set(row[0] for row in updated)
+    changed.update(row[0] for row in inserted)
+    upserted = len(changed)
+    self.touched.update(source for bug_number, source, fixed, found in bug_sources if bug_number in changed)
+    deleted = self.session.execute("""
+      DELETE FROM bug_source bs
+       USING bug b
+       WHERE bs.bug_id = b.id AND b.bug_tracker_id = :bug_tracker_id
+         AND b.bug_number IN (SELECT bug_number FROM bug_new)
+         AND NOT EXISTS (SELECT 1 FROM bug_source_new n WHERE n.bug_number = b.bug_number AND n.source = bs.source)
+      RETURNING bs.source""",
+      params).fetchall()
+    self.touched.update(row[0] for row in deleted)
+    updated = self.session.execute("""
+      UPDATE bug_source bs
+         SET (fixed_versions, found_versions) = (n.fixed_versions::debversion[], n.found_versions::debversion[])
+        FROM (SELECT DISTINCT ON (bug_number, source) * FROM bug_source_new) n, bug b
+       WHERE b.bug_tracker_id = :bug_tracker_id AND b.bug_number = n.bug_number
+         AND bs.bug_id = b.id AND bs.source = n.source
+         AND (bs.fixed_versions, bs.found_versions)
+             IS DISTINCT FROM (n.fixed_versions::debversion[], n.found_versions::debversion[])
+      RETURNING bs.source""",
+      params).fetchall()
+    self.touched.update(row[0] for row in updated)
+    inserted = self.session.execute("""
+      INSERT INTO bug_source (bug_id, source, fixed_versions, found_versions)
+      SELECT DISTINCT ON (b.id, n.source) b.id, n.source, n.fixed_versions::debversion[], n.found_versions::debversion[]
+        FROM bug_source_new n
+        JOIN bug b ON b.bug_tracker_id = :bug_tracker_id AND b.bug_number = n.bug_number
+       WHERE NOT EXISTS (SELECT 1 FROM bug_source bs WHERE bs.bug_id = b.id AND bs.source = n.source)
+      RETURNING source""",
+      params).fetchall()
+    self.touched.update(row[0] for row in inserted)
+    total = self.session.execute("SELECT count(*) FROM bug_new").scalar()
+    print "I: Updated {0} bug reports, {1} new or changed".format(total, upserted)
 
   def run(self, named_trees=None):
-    # TODO: Add binary_source_map
-    bts = pet.bts.DebianBugTracker({}, ignore_unknown_binaries=True)
-    # TODO: Unify code path once _delete_unreferenced_bugs is fixed
-    # to no longer need the list of sources.
+    binary_source_map = self.binary_source_map()
+    print "D: Loaded sources of {0} binary packages".format(len(binary_source_map))
+    bts = pet.bts.DebianBugTracker(binary_source_map, ignore_unknown_binaries=True,
+        jobs=self.jobs, batch_size=self.batch_size)
     if named_trees is None:
       sources = [ s[0] for s in self.session.query(NamedTree.source).distinct() ]
-      self._delete_unreferenced_bugs(sources)
-      bug_numbers = [ b[0] for b in self.session.query(Bug.bug_number).filter_by(bug_tracker=self.bug_tracker).all() ]
-      bug_reports = bts.search(sources, bug_numbers)
+      full = self.full
+      if full is None:
+        full = self.full_sync_due()
+      if not full and self._config('bts_change_feed') is None:
+        print "I: No bts_change_feed configured, changes of known bugs need a full sync"
+        full = True
+      elif not full and self.bug_tracker.last_modified_watermark is None:
+        print "I: No last_modified_watermark yet, changes of known bugs need a full sync"
+        full = True
+      if full:
+        bug_numbers = [ b[0] for b in self.session.query(Bug.bug_number).filter_by(bug_tracker=self.bug_tracker).all() ]
+        print "I: Full sync of {0} known bugs".format(len(bug_numbers))
+        bug_reports = bts.search(sources, bug_numbers)
+      else:
+        bug_reports = bts.status(self.changed_bugs(bts, sources))
       self._update_bugs(bug_reports)
+      self._store_watermark(full)
     else:
       sources = list(set([ nt.source for nt in named_trees ]))
       bug_reports = bts.search(sources)
       self._update_bugs(bug_reports)
+    self._delete_unreferenced_bugs()
+    _refresh_status(self.session, self.touched)
 
 class WatchUpdater(object):
-  def __init__(self, session):
+  """check debian/watch of trunk named trees for new upstream versions
+
+  With `jobs` > 1 the watch files are checked by a pool of threads;
+  only the network access and version comparison happens there, all
+  database changes are still done in the session's thread.
+
+  Upstream pages are fetched through `cache` (a `pet.cache.PageCache`);
+  by default pages are only cached in memory for the run.
+  """
+  def __init__(self, session, jobs=1, per_host=None, cache=None):
     self.session = session
-    self.watcher = pet.watch.Watcher()
+    self.jobs = jobs
+    if cache is None:
+      cache = pet.cache.PageCache()
+    self.cache = cache
+    self.watcher = pet.watch.Watcher(per_host=per_host, cache=cache)
 
-  def update_watch(self, watch):
-    if watch.contents is None:
-      return
-    result = self.watcher.check(watch.contents)
+  def _store(self, watch, result):
     if result['errors'] is None:
       wr = WatchResult(named_tree=watch.named_tree, homepage=result['homepage'], upstream_version=str(result['version']), download_url=result['url'], debian_version=result['dversionmangle'](watch.named_tree.version))
     else:
       error = ", ".join([ str(e) for e in result['errors'] ])
       wr = WatchResult(named_tree=watch.named_tree, homepage=result.get('homepage'), error=error)
     self.session.add(wr)
+  def update_watch(self, watch):
+    if watch.contents is None:
+      return
+    self._store(watch, self.watcher.check(watch.contents))
+  def _check_watches(self, watches):
+    """check watch files
+
+    Yields tuples (watch, result, seconds) in the order the checks
+    finish.
+    """
+    if self.jobs <= 1:
+      for watch in watches:
+        print "D: checking watch for {0}".format(watch.named_tree.source)
+        start = time.time()
+        result = self.watcher.check(watch.contents)
+        yield watch, result, time.time() - start
+      return
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    for i, watch in enumerate(watches):
+      tasks.put((i, watch.contents))
+    def worker():
+      while True:
+        try:
+          i, contents = tasks.get_nowait()
+        except Queue.Empty:
+          return
+        start = time.time()
+        try:
+          results.put((i, self.watcher.check(contents), time.time() - start, None))
+        except:
+          results.put((i, None, time.time() - start, sys.exc_info()))
+    for n in range(min(self.jobs, len(watches))):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+
+    for n in range(len(watches)):
+      # Queue.get only reacts to KeyboardInterrupt when given a timeout.
+      i, result, elapsed, exc_info = results.get(True, 86400)
+      if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+      print "D: checked watch for {0} ({1:.1f}s)".format(watches[i].named_tree.source, elapsed)
+      yield watches[i], result, elapsed
+  def _print_statistics(self, latencies, elapsed):
+    if not latencies:
+      return
+    latencies = sorted(latencies)
+    def percentile(p):
+      return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+    print "I: Checked {0} watch files in {1:.1f}s ({2:.2f}/s, {3} jobs)".format(len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0.0, self.jobs)
+    print "I: Latency p50 {0:.2f}s, p90 {1:.2f}s, p99 {2:.2f}s, max {3:.2f}s".format(percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1])
   def run(self, named_trees=None):
     self.session.begin_nested()
     try:
@@ -413,12 +1026,24 @@ class WatchUpdater(object):
       watches = self.session.query(File) \
           .filter(File.name == 'debian/watch') \
           .filter(File.named_tree_id.in_(named_trees.from_self(NamedTree.id).subquery())) \
-          .options(sqlalchemy.orm.joinedload(File.named_tree))
+          .options(sqlalchemy.orm.joinedload(File.named_tree)) \
+          .options(sqlalchemy.orm.joinedload(File.blob))
       self.session.query(WatchResult) \
           .filter(WatchResult.named_tree_id.in_(named_trees.from_self(NamedTree.id).subquery())).delete(False)
-      for watch in watches:
-        print "D: checking watch for {0}".format(watch.named_tree.source)
-        self.update_watch(watch)
+      watches = [ w for w in watches if w.contents is not None ]
+      latencies = []
+      start = time.time()
+      for watch, result, elapsed in self._check_watches(watches):
+        self._store(watch, result)
+        latencies.append(elapsed)
+      self._print_statistics(latencies, time.time() - start)
+      self.session.flush()
+      pet.classifier.refresh_package_status(self.session,
+          NamedTree.id.in_(named_trees.from_self(NamedTree.id).subquery()))
+      self.cache.expire()
+      self.watcher.save()
+      print "I: Page cache: {0}".format(self.cache.statistics())
+      print "D: {0}".format(self.watcher.statistics())
     except:
       self.session.rollback()
       raise
@@ -15,15 +15,19 @@
 
 from pet.exceptions import *
 
+import httplib
 import json
+import socket
 import StringIO
 import subprocess
 import svn.client
 import svn.core
 import svn.ra
+import threading
 import time
 import urllib2
 import urllib
+import urlparse
 
 _vcs_backends = {}
 def _vcs_backend(name):
@@ -33,11 +37,128 @@ def _vcs_backend(name):
     return cls
   return helper
 
+class _TokenBucket(object):
+  """rate limiter allowing `rate` requests per second with bursts of `burst`"""
+  def __init__(self, rate, burst=1):
+    self.rate = float(rate)
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last = time.time()
+    self._lock = threading.Lock()
+  def acquire(self):
+    """wait until a request may be made"""
+    while True:
+      with self._lock:
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        delay = (1 - self._tokens) / self.rate
+      time.sleep(delay)
+
+class _HTTPConnectionPool(object):
+  """keep-alive connections to HTTP servers, reused across requests
+
+  Requests that go through a proxy or get redirected are left to
+  urllib2, which knows how to handle both.
+  """
+  def __init__(self, size=4, timeout=180):
+    self.size = size
+    self.timeout = timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+    self._proxies = urllib.getproxies()
+  def _proxied(self, scheme, netloc):
+    host = netloc.rpartition('@')[2]
+    return scheme in self._proxies and not urllib.proxy_bypass(host)
+  def _urlopen(self, url):
+    try:
+      fh = urllib2.urlopen(url, timeout=self.timeout)
+    except urllib2.HTTPError as e:
+      return e.code, e.read()
+    try:
+      return fh.getcode(), fh.read()
+    finally:
+      fh.close()
+  def _connection(self, scheme, netloc):
+    with self._lock:
+      idle = self._idle.get((scheme, netloc))
+      if idle:
+        return idle.pop()
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+    return httplib.HTTPConnection(netloc, timeout=self.timeout)
+  def _release(self, scheme, netloc, connection):
+    with self._lock:
+      idle = self._idle.setdefault((scheme, netloc), [])
+      if len(idle) < self.size:
+        idle.append(connection)
+        return
+    connection.close()
+  def get(self, url):
+    """returns a tuple ``(status, contents)`` for a GET request of `url`"""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if self._proxied(scheme, netloc):
+      return self._urlopen(url)
+    if query:
+      path += '?' + query
+    # An idle connection may have been closed by the server in the
+    # meantime, so retry once with a fresh one.
+    for attempt in (1, 2):
+      connection = self._connection(scheme, netloc)
+      try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        contents = response.read()
+      except (httplib.HTTPException, socket.error):
+        connection.close()
+        if attempt == 2:
+          raise
+        continue
+      if response.will_close:
+        connection.close()
+      else:
+        self._release(scheme, netloc, connection)
+      if 300 <= response.status < 400:
+        return self._urlopen(url)
+      return response.status, contents
+  def close(self):
+    with self._lock:
+      for idle in self._idle.values():
+        for connection in idle:
+          connection.close()
+      self._idle = {}
+
 def vcs_backend(repository):
   return _vcs_backends[repository.type](repository)
 
 class VCS(object):
-  pass
+  def files(self, package, filenames, branch=None, tag=None):
+    """
+    returns a dict mapping each of `filenames` to its contents,
+    or None if the file does not exist
+    """
+    result = {}
+    for filename in filenames:
+      try:
+        result[filename] = self.file(package, filename, branch=branch, tag=tag)
+      except FileNotFound:
+        result[filename] = None
+    return result
+  def object_ids(self, package, filenames, branch=None, tag=None):
+    """
+    returns a dict mapping each of `filenames` to an identifier that
+    changes whenever the file changes, or None if the file does not
+    exist
+
+    Returns None if the backend cannot provide such identifiers.
+    """
+    return None
+  def close(self):
+    """release connections or processes held by the backend"""
+    pass
 
 class _SubversionCallbacks(svn.ra.Callbacks):
   def __init__(self):
@@ -78,17 +199,19 @@ class Subversion(VCS):
       extra = "?view=markup"
 
     return "{0}/{1}/{2}{3}".format(self.web_root, prefix, filename, extra)
-  def file(self, package, filename, branch=None, tag=None):
-    """
-    returns file contents
-    """
+  def _path(self, package, filename, branch=None, tag=None):
     assert not (branch and tag), "cannot give both branch and tag"
     if branch:
-      path = "branches/{1}/{0}/{2}".format(package, branch, filename)
+      return "branches/{1}/{0}/{2}".format(package, branch, filename)
     elif tag:
-      path = "tags/{0}/{1}/{2}".format(package, tag, filename)
+      return "tags/{0}/{1}/{2}".format(package, tag, filename)
     else:
-      path = "trunk/{0}/{1}".format(package, filename)
+      return "trunk/{0}/{1}".format(package, filename)
+  def file(self, package, filename, branch=None, tag=None):
+    """
+    returns file contents
+    """
+    path = self._path(package, filename, branch=branch, tag=tag)
     try:
       stream = StringIO.StringIO()
       svn.ra.svn_ra_get_file(self.ra, path, self.rev, stream)
@@ -97,6 +220,20 @@ class Subversion(VCS):
         raise FileNotFound(e.message)
       raise VCSException(e)
     return stream.getvalue()
+  def object_ids(self, package, filenames, branch=None, tag=None):
+    """uses the revision each file was last changed in"""
+    result = {}
+    for filename in filenames:
+      path = self._path(package, filename, branch=branch, tag=tag)
+      try:
+        dirent = svn.ra.svn_ra_stat(self.ra, path, self.rev)
+      except svn.core.SubversionException as e:
+        raise VCSException(e)
+      if dirent is None or dirent.kind != svn.core.svn_node_file:
+        result[filename] = None
+      else:
+        result[filename] = str(dirent.created_rev)
+    return result
   def _list(self, path):
     """
     retrieve list of (name, commit) of subdirectories in path
@@ -216,10 +353,22 @@ class Subversion(VCS):
 
 @_vcs_backend("git")
 class Git(VCS):
+  """Git repositories accessed through gitweb
+
+  Requests to gitweb are limited to `rate_limit` per second with bursts
+  of up to `rate_burst` requests, both taken from the repository
+  configuration.  Connections are kept alive between requests.
+  """
+  rate_limit = 1.0
+  rate_burst = 4
   def __init__(self, repository):
     self.root = repository.root
     self.web_root = repository.web_root
     self._summary_cache = None
+    rate_limit = getattr(repository, 'rate_limit', None) or self.rate_limit
+    rate_burst = getattr(repository, 'rate_burst', None) or self.rate_burst
+    self._rate_limiter = _TokenBucket(rate_limit, rate_burst)
+    self._pool = _HTTPConnectionPool(rate_burst)
   def link(self, package, filename=None, directory=False, branch=None, tag=None, named_tree=None):
     assert not (named_tree and (branch or tag)), "cannot give both named_tree and branch or tag"
     if named_tree is not None:
@@ -256,16 +405,50 @@ class Git(VCS):
       extra = ""
     url = "{0}/{1}.git;a=blob_plain;f={2}{3}".format(self.web_root, urllib.quote(package), urllib.quote(filename), extra)
 
-    try:
-      f = urllib2.urlopen(url)
-      contents = f.read()
-      f.close()
-    except urllib2.HTTPError as e:
-      if e.code == 404:
-        return None
-      raise
-    time.sleep(3)
+    self._rate_limiter.acquire()
+    status, contents = self._pool.get(url)
+    if status == 404:
+      return None
+    if status != 200:
+      raise VCSException("Fetching {0} failed with HTTP status {1}".format(url, status))
     return contents
+  def files(self, package, filenames, branch=None, tag=None):
+    """
+    returns a dict mapping each of `filenames` to its contents,
+    or None if the file does not exist
+
+    Up to `rate_burst` files are fetched in parallel.
+    """
+    if self._rate_limiter.burst <= 1 or len(filenames) <= 1:
+      return super(Git, self).files(package, filenames, branch=branch, tag=tag)
+    result = {}
+    errors = []
+    pending = list(filenames)
+    lock = threading.Lock()
+    def worker():
+      while True:
+        with lock:
+          if not pending or errors:
+            return
+          filename = pending.pop()
+        try:
+          contents = self.file(package, filename, branch=branch, tag=tag)
+        except Exception as e:
+          with lock:
+            errors.append(e)
+          return
+        with lock:
+          result[filename] = contents
+    threads = [ threading.Thread(target=worker) for i in range(min(self._rate_limiter.burst, len(filenames))) ]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    if errors:
+      raise errors[0]
+    return result
+  def close(self):
+    self._pool.close()
   @property
   def _summary(self):
     if self._summary_cache is None:
@@ -332,20 +515,101 @@ class Git(VCS):
           add_changed(trunk)
     return changed
 
+class _CatFileBatch(object):
+  """a running ``git cat-file --batch`` process"""
+  def __init__(self, cwd):
+    self.cwd = cwd
+    self._process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=cwd,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._check = None
+  def blobs(self, objects):
+    """
+    returns the contents of the given blobs as a list, with None for
+    objects that do not exist or are not blobs
+    """
+    # git cat-file flushes its output after each object, so writing all
+    # requests first cannot dead-lock for a handful of requests.
+    self._process.stdin.write("".join("{0}\n".format(o) for o in objects))
+    self._process.stdin.flush()
+    result = []
+    for o in objects:
+      header = self._process.stdout.readline()
+      if not header:
+        raise VCSException("git cat-file --batch in {0} exited unexpectedly".format(self.cwd))
+      fields = header.split()
+      if fields[-1] in ('missing', 'ambiguous'):
+        result.append(None)
+        continue
+      # <sha1> <type> <size>
+      contents = self._process.stdout.read(int(fields[2]))
+      self._process.stdout.read(1) # trailing newline
+      if fields[1] != 'blob':
+        contents = None
+      result.append(contents)
+    return result
+  def object_ids(self, objects):
+    """
+    returns the object ids of the given blobs as a list, with None for
+    objects that do not exist or are not blobs
+    """
+    if self._check is None:
+      self._check = subprocess.Popen(['git', 'cat-file', '--batch-check'], cwd=self.cwd,
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._check.stdin.write("".join("{0}\n".format(o) for o in objects))
+    self._check.stdin.flush()
+    result = []
+    for o in objects:
+      header = self._check.stdout.readline()
+      if not header:
+        raise VCSException("git cat-file --batch-check in {0} exited unexpectedly".format(self.cwd))
+      # <sha1> <type> <size>, or <object> missing
+      fields = header.split()
+      if fields[-1] in ('missing', 'ambiguous') or fields[1] != 'blob':
+        result.append(None)
+      else:
+        result.append(fields[0])
+    return result
+  def close(self):
+    for process in (self._process, self._check):
+      if process is not None:
+        process.stdin.close()
+        process.wait()
+
 @_vcs_backend("git-local")
 class GitLocal(Git):
+  """Git repositories on the local file system
+
+  Files are read through one long-lived ``git cat-file --batch`` process
+  for the package that was accessed last.
+  """
   def __init__(self, repository):
     super(GitLocal, self).__init__(repository)
-  def file(self, package, filename, branch=None, tag=None):
+    self._batch = None
+  def __del__(self):
+    self.close()
+  def close(self):
+    if self._batch is not None:
+      self._batch.close()
+      self._batch = None
+  def _cat_file(self, package):
+    cwd = '{0}.d/{1}.git'.format(self.root, package)
+    if self._batch is None or self._batch.cwd != cwd:
+      self.close()
+      self._batch = _CatFileBatch(cwd)
+    return self._batch
+  def files(self, package, filenames, branch=None, tag=None):
     assert not (branch and tag), "cannot give both branch and tag"
     tree = branch or tag or 'HEAD'
-    cmd = ['git', 'cat-file', 'blob', '{0}:{1}'.format(tree, filename)]
-    cwd = '{0}.d/{1}.git'.format(self.root, package)
-    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode != 0:
-      return None
-    return stdout
+    objects = [ '{0}:{1}'.format(tree, filename) for filename in filenames ]
+    return dict(zip(filenames, self._cat_file(package).blobs(objects)))
+  def object_ids(self, package, filenames, branch=None, tag=None):
+    """uses git's blob ids"""
+    assert not (branch and tag), "cannot give both branch and tag"
+    tree = branch or tag or 'HEAD'
+    objects = [ '{0}:{1}'.format(tree, filename) for filename in filenames ]
+    return dict(zip(filenames, self._cat_file(package).object_ids(objects)))
+  def file(self, package, filename, branch=None, tag=None):
+    return self.files(package, [filename], branch=branch, tag=tag)[filename]
   @property
   def _summary(self):
     if self._summary_cache is None:
@@ -354,24 +618,94 @@ class GitLocal(Git):
         self._summary_cache = json.loads(contents)
     return self._summary_cache
 
+class _PetCatFileBatch(object):
+  """a running ``pet-cat-file`` in batch mode
+
+  `command` starts pet-cat-file, usually through ssh.  Requests are
+  written as ``<repository> <object>`` lines, replies are the size of
+  the blob on a line of its own followed by its contents, or the line
+  ``missing``.  Requests ``info <repository> <object>`` are answered
+  with the blob id instead.
+  """
+  def __init__(self, command):
+    self.command = command
+    self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  def blobs(self, repository, objects):
+    """
+    returns the contents of the given blobs in `repository` as a list,
+    with None for objects that do not exist
+    """
+    self._process.stdin.write("".join("{0} {1}\n".format(repository, o) for o in objects))
+    self._process.stdin.flush()
+    result = []
+    for o in objects:
+      header = self._process.stdout.readline()
+      if not header:
+        raise VCSException("{0} exited unexpectedly".format(" ".join(self.command)))
+      header = header.rstrip("\n")
+      if header == 'missing':
+        result.append(None)
+      else:
+        result.append(self._process.stdout.read(int(header)))
+    return result
+  def object_ids(self, repository, objects):
+    """
+    returns the ids of the given blobs in `repository` as a list,
+    with None for objects that do not exist
+    """
+    self._process.stdin.write("".join("info {0} {1}\n".format(repository, o) for o in objects))
+    self._process.stdin.flush()
+    result = []
+    for o in objects:
+      header = self._process.stdout.readline()
+      if not header:
+        raise VCSException("{0} exited unexpectedly".format(" ".join(self.command)))
+      header = header.rstrip("\n")
+      result.append(None if header == 'missing' else header)
+    return result
+  def close(self):
+    self._process.stdin.close()
+    self._process.wait()
+
 @_vcs_backend("git-ssh")
 class GitSsh(Git):
+  """Git repositories accessed through the pet-cat-file forced command
+
+  All files are read over a single ssh session running pet-cat-file in
+  batch mode that stays open until `close` is called.
+  """
   def __init__(self, repository):
     super(GitSsh, self).__init__(repository)
-  def file(self, package, filename, branch=None, tag=None):
+    self._batch = None
+  def __del__(self):
+    self.close()
+  def close(self):
+    if self._batch is not None:
+      self._batch.close()
+      self._batch = None
+  def _command(self, *args):
+    return ['ssh', 'pet-cat-file', 'cd', self.root, ';'] + list(args)
+  def files(self, package, filenames, branch=None, tag=None):
     assert not (branch and tag), "cannot give both branch and tag"
     tree = branch or tag or 'HEAD'
-    cwd = '{0}/{1}.git'.format(self.root, package)
-    cmd = ['ssh', 'pet-cat-file', 'cd', cwd, ';', 'git', 'cat-file', 'blob', '{0}:{1}'.format(tree, filename)]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
-    if p.returncode != 0:
-      return None
-    return stdout
+    if self._batch is None:
+      self._batch = _PetCatFileBatch(self._command('pet-batch'))
+    objects = [ '{0}:{1}'.format(tree, filename) for filename in filenames ]
+    return dict(zip(filenames, self._batch.blobs('{0}.git'.format(package), objects)))
+  def object_ids(self, package, filenames, branch=None, tag=None):
+    """uses git's blob ids"""
+    assert not (branch and tag), "cannot give both branch and tag"
+    tree = branch or tag or 'HEAD'
+    if self._batch is None:
+      self._batch = _PetCatFileBatch(self._command('pet-batch'))
+    objects = [ '{0}:{1}'.format(tree, filename) for filename in filenames ]
+    return dict(zip(filenames, self._batch.object_ids('{0}.git'.format(package), objects)))
+  def file(self, package, filename, branch=None, tag=None):
+    return self.files(package, [filename], branch=branch, tag=tag)[filename]
   @property
   def _summary(self):
     if self._summary_cache is None:
-      cmd = ['ssh', 'pet-cat-file', 'cd', self.root, ';', 'pet-summary']
+      cmd = self._command('pet-summary')
       p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
       (stdout, stderr) = p.communicate()
       if p.returncode != 0:
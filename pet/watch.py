@@ -16,14 +16,24 @@
 from pet.exceptions import *
 import pet.perlre
 
+import array
+import bisect
+import cPickle
 import debian.debian_support
-import gzip
+import ftplib
+import hashlib
 import httplib
+import os
+import os.path
 import re
+import sre_constants
+import sre_parse
 import ssl
-import StringIO
+import threading
+import urllib
 import urllib2
 import urlparse
+import zlib
 
 _re_upstream_version = re.compile(r'^(?:\d+:)?(.*?)(?:-[a-zA-Z0-9+.~]*)?$')
 
@@ -172,11 +182,113 @@ _re_href = re.compile("""href=(?:"([^"]+)"|'([^']+)'|([^'">]+))""")
 _re_sf = re.compile(r'^http://sf\.net/')
 
 class Watcher(object):
-  def __init__(self):
-    self._cpan = CPAN()
+  """check watch files for new upstream versions
+
+  `Watcher.check` may be called from several threads at once.  If
+  `per_host` is given, at most that many downloads from the same host
+  are run in parallel.  Pages are fetched through `cache`, a
+  `pet.cache.PageCache`, if one is given.
+
+  Parsed watch files are remembered by a hash of their contents.  If the
+  cache has a directory, they are also kept there between runs (see
+  `save`).
+  """
+  # version of the pickled parsed watch files
+  FORMAT = 1
+  def __init__(self, per_host=None, cache=None):
+    cache_directory = cache.directory if cache is not None else None
+    self._cpan = CPAN(cache_directory=cache_directory)
+    self._per_host = per_host
+    self._cache = cache
+    self._host_semaphores = {}
+    self._lock = threading.Lock()
+    self._watch_files = {}
+    self._watch_files_path = None
+    self._persisted_watch_files = {}
+    self.parsed = 0
+    self.reused = 0
+    if cache_directory is not None:
+      self._watch_files_path = os.path.join(cache_directory, 'watch-files.pickle')
+      try:
+        with open(self._watch_files_path, 'rb') as fh:
+          persisted = cPickle.load(fh)
+        if persisted.get('format') == self.FORMAT:
+          self._persisted_watch_files = persisted['watch_files']
+      except (IOError, EOFError, KeyError, AttributeError, cPickle.UnpicklingError):
+        pass
+  def save(self):
+    """store the watch files parsed in this run in the cache directory"""
+    if self._watch_files_path is None:
+      return
+    tmp = self._watch_files_path + '.new'
+    with self._lock:
+      with open(tmp, 'wb') as fh:
+        cPickle.dump(dict(format=self.FORMAT, watch_files=self._watch_files), fh, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, self._watch_files_path)
+  def statistics(self):
+    total = self.parsed + self.reused
+    return "{0} watch files parsed, {1} reused ({2:.0%} skipped)".format(
+        self.parsed, self.reused, float(self.reused) / total if total else 0.0)
+  def _parse(self, watch_file):
+    """returns the `WatchFile` for `watch_file`, parsing it only once
+
+    Errors from parsing are remembered and raised again.
+    """
+    if isinstance(watch_file, unicode):
+      key = hashlib.sha1(watch_file.encode('utf-8')).hexdigest()
+    else:
+      key = hashlib.sha1(watch_file).hexdigest()
+    with self._lock:
+      watch = self._watch_files.get(key)
+      if watch is None:
+        watch = self._persisted_watch_files.pop(key, None)
+      if watch is not None:
+        self._watch_files[key] = watch
+        self.reused += 1
+    if watch is None:
+      try:
+        watch = WatchFile(watch_file)
+      except (InvalidWatchFile, RegexpError) as e:
+        watch = e
+      with self._lock:
+        self._watch_files[key] = watch
+        self.parsed += 1
+    if isinstance(watch, Exception):
+      raise watch
+    return watch
+  def _host_semaphore(self, url):
+    host = urlparse.urlparse(url).netloc
+    with self._lock:
+      semaphore = self._host_semaphores.get(host)
+      if semaphore is None:
+        semaphore = threading.BoundedSemaphore(self._per_host)
+        self._host_semaphores[host] = semaphore
+    return semaphore
+  def _fetch(self, url, headers={}):
+    """download `url`, honoring the per-host limit
+
+    Returns a tuple (info, contents).
+    """
+    if self._per_host is not None:
+      semaphore = self._host_semaphore(url)
+      semaphore.acquire()
+    try:
+      fh = urlopen(urllib2.Request(url, headers=headers), timeout=TIMEOUT())
+      contents = fh.read()
+      info = fh.info()
+      fh.close()
+      return info, contents
+    finally:
+      if self._per_host is not None:
+        semaphore.release()
+  def _download(self, url):
+    """returns the contents of `url`"""
+    if self._cache is None:
+      return self._fetch(url)[1]
+    return self._cache.get(url, self._fetch)
   def check(self, watch_file):
     try:
-      watch = WatchFile(watch_file)
+      watch = self._parse(watch_file)
     except InvalidWatchFile as e:
       return dict(errors=[e])
     except RegexpError:
@@ -211,9 +323,7 @@ class Watcher(object):
       if results is None:
         results = []
         homepage = _re_sf.sub('http://qa.debian.org/watch/sf.php/', rule.homepage)
-        fh = urlopen(homepage, timeout=TIMEOUT())
-        contents = fh.read()
-        fh.close()
+        contents = self._download(homepage)
         if _re_http.match(homepage):
           # join all groups, only one in non-empty and contains the link
           links = [ "".join(l) for l in _re_href.findall(contents) ]
@@ -252,18 +362,319 @@ class Watcher(object):
 
 _re_cpan_dist = re.compile(r'/dist/|/release/')
 _re_cpan_files = re.compile(r'/authors/id/|/modules/by-module/')
+_re_cpan_any_dir = re.compile(r'\A(?:\.[*+]/|\(\?:\.[*+]/\)\?)')
+
+def _has_toplevel_alternation(pattern):
+  depth = 0
+  in_class = False
+  escaped = False
+  for c in pattern:
+    if escaped:
+      escaped = False
+    elif c == '\\':
+      escaped = True
+    elif in_class:
+      if c == ']':
+        in_class = False
+    elif c == '[':
+      in_class = True
+    elif c == '(':
+      depth += 1
+    elif c == ')':
+      depth -= 1
+    elif c == '|' and depth == 0:
+      return True
+  return False
+
+def _literal_prefix(pattern):
+  """returns literal text all strings matching `pattern` start with"""
+  if _has_toplevel_alternation(pattern):
+    return ''
+  prefix = []
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if c == '\\':
+      if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+        break
+      literal = pattern[i + 1]
+      i += 2
+    elif c in '.^$*+?{}[]|()':
+      break
+    else:
+      literal = c
+      i += 1
+    # the last literal is optional
+    if i < len(pattern) and pattern[i] in '?*{':
+      break
+    prefix.append(literal)
+  prefix = ''.join(prefix)
+  if isinstance(prefix, unicode):
+    prefix = prefix.encode('utf-8')
+  return prefix
+
+def _set_may_match_slash(items):
+  negate = False
+  found = False
+  for op, av in items:
+    if op == sre_constants.NEGATE:
+      negate = True
+    elif op == sre_constants.LITERAL:
+      found = found or av == ord('/')
+    elif op == sre_constants.RANGE:
+      found = found or av[0] <= ord('/') <= av[1]
+    elif op == sre_constants.CATEGORY:
+      found = found or 'not' in av
+    else:
+      found = True
+  return found != negate
+
+def _may_match_slash(items):
+  """check if the parsed expression `items` can match a '/'
+
+  Unknown constructs are assumed to match one.
+  """
+  for op, av in items:
+    if op == sre_constants.LITERAL:
+      if av == ord('/'):
+        return True
+    elif op == sre_constants.NOT_LITERAL:
+      if av != ord('/'):
+        return True
+    elif op == sre_constants.IN:
+      if _set_may_match_slash(av):
+        return True
+    elif op == sre_constants.SUBPATTERN:
+      if _may_match_slash(av[1]):
+        return True
+    elif op == sre_constants.BRANCH:
+      if any(_may_match_slash(branch) for branch in av[1]):
+        return True
+    elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+      if _may_match_slash(av[2]):
+        return True
+    elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+      pass
+    else:
+      return True
+  return False
+
+def _bisect(length, key, value):
+  """returns the first i in range(length) with key(i) >= value"""
+  lo, hi = 0, length
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if key(mid) < value:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+class _CPANIndex(object):
+  """list of files on a CPAN mirror
+
+  The index is built from (directory, name) pairs, which should be
+  grouped by directory.  Each directory name is stored once per group,
+  the file names are stored in newline-separated chunks of about
+  `CHUNK_SIZE` bytes plus an array of offsets.  This is much smaller
+  than a list of Python strings.
+
+  `candidates` uses the literal prefix of a pattern to select the paths
+  that might match it: either the prefix of the whole path (patterns
+  like ``authors/id/A/AB/ABC/Foo-(.*)``) or, for patterns starting with
+  ``.*/``, the prefix of the file name.  The remainder of such patterns
+  is assumed to match within the file name.
+  """
+  # version of the pickled representation
+  FORMAT = 3
+  CHUNK_SIZE = 1024 * 1024
+  # length of file name prefixes used as bucket keys
+  NAME_KEY = 3
+  def __init__(self, entries):
+    self._directories = []
+    self._group_starts = array.array('I')
+    self._chunks = []
+    self._chunk_starts = array.array('I')
+    self._offsets = array.array('I')
+    self._by_name = {}
+    pending = []
+    size = 0
+    for i, (directory, name) in enumerate(entries):
+      if not self._directories or self._directories[-1] != directory:
+        self._directories.append(directory)
+        self._group_starts.append(i)
+      if size >= self.CHUNK_SIZE:
+        self._add_chunk(pending, i)
+        pending = []
+        size = 0
+      self._offsets.append(size)
+      pending.append(name)
+      size += len(name) + 1
+      bucket = self._by_name.get(name[:self.NAME_KEY])
+      if bucket is None:
+        bucket = self._by_name[name[:self.NAME_KEY]] = array.array('I')
+      bucket.append(i)
+    if pending:
+      self._add_chunk(pending, len(self._offsets))
+    self._group_starts.append(len(self._offsets))
+    self._sorted_groups = array.array('I', sorted(xrange(len(self._directories)), key=self._directories.__getitem__))
+  def _add_chunk(self, names, end):
+    self._chunk_starts.append(end - len(names))
+    self._chunks.append("\n".join(names) + "\n")
+  def __len__(self):
+    return len(self._offsets)
+  def name(self, i):
+    chunk = self._chunks[bisect.bisect_right(self._chunk_starts, i) - 1]
+    start = self._offsets[i]
+    return chunk[start:chunk.index("\n", start)]
+  def path(self, i):
+    directory = self._directories[bisect.bisect_right(self._group_starts, i) - 1]
+    return "{0}/{1}".format(directory, self.name(i))
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self.path(i)
+  def _group(self, group, prefix=''):
+    for i in xrange(self._group_starts[group], self._group_starts[group + 1]):
+      if self.name(i).startswith(prefix):
+        yield self.path(i)
+  def _path_candidates(self, prefix):
+    directory, sep, name = prefix.rpartition('/')
+    key = lambda i: self._directories[self._sorted_groups[i]]
+    i = _bisect(len(self._sorted_groups), key, directory)
+    while i < len(self._sorted_groups) and key(i).startswith(directory):
+      group_directory = key(i)
+      if group_directory == directory:
+        for path in self._group(self._sorted_groups[i], name):
+          yield path
+      elif (group_directory + '/').startswith(prefix):
+        for path in self._group(self._sorted_groups[i]):
+          yield path
+      i += 1
+  def _name_candidates(self, prefix):
+    if len(prefix) >= self.NAME_KEY:
+      keys = [ prefix[:self.NAME_KEY] ]
+    else:
+      keys = [ k for k in self._by_name if k.startswith(prefix) ]
+    for key in keys:
+      for i in self._by_name.get(key, ()):
+        if self.name(i).startswith(prefix):
+          yield self.path(i)
+  def candidates(self, pattern):
+    source = pattern.pattern
+    if source.startswith('\\A'):
+      source = source[2:]
+    prefix = _literal_prefix(source)
+    if prefix:
+      return self._path_candidates(prefix)
+    match = _re_cpan_any_dir.match(source)
+    if match:
+      rest = source[match.end():]
+      prefix = _literal_prefix(rest)
+      # The prefix only starts the file name if the rest of the pattern
+      # cannot match further directories.
+      try:
+        in_name = not _may_match_slash(sre_parse.parse(rest, pattern.flags))
+      except (sre_constants.error, ValueError):
+        in_name = False
+      if prefix and in_name:
+        return self._name_candidates(prefix)
+    return iter(self)
+
+def _ftp_mtime(url):
+  """returns the modification time of a file on an FTP server, or None"""
+  parts = urlparse.urlsplit(url)
+  ftp = ftplib.FTP(timeout=TIMEOUT())
+  try:
+    ftp.connect(parts.hostname, parts.port or ftplib.FTP_PORT)
+    if parts.username:
+      ftp.login(urllib.unquote(parts.username), urllib.unquote(parts.password or ''))
+    else:
+      ftp.login()
+    reply = ftp.sendcmd('MDTM {0}'.format(urllib.unquote(parts.path)))
+  except ftplib.all_errors:
+    return None
+  finally:
+    ftp.close()
+  return reply.split(None, 1)[1]
+
+def _index_stamp(url, info):
+  """identify a version of an index file
+
+  The size alone could miss a change, so a stamp needs the
+  modification time (Last-Modified, or MDTM for FTP) or an ETag.
+  """
+  last_modified = info.getheader('Last-Modified')
+  if last_modified is None and url.startswith('ftp:'):
+    last_modified = _ftp_mtime(url)
+  etag = info.getheader('ETag')
+  if last_modified is None and etag is None:
+    return None
+  return (last_modified, etag, info.getheader('Content-Length'))
 
 class CPAN(object):
-  def __init__(self, mirror='ftp://ftp.cs.uu.nl/pub/CPAN/'):
+  """search CPAN's package and file lists
+
+  The lists are downloaded once per run.  With a `cache_directory` the
+  parsed index is kept between runs and only rebuilt when the index
+  file on the mirror changes.
+  """
+  def __init__(self, mirror='ftp://ftp.cs.uu.nl/pub/CPAN/', cache_directory=None):
     self.mirror = mirror
+    self.cache_directory = cache_directory
     self._dists = None
     self._files = None
+    self._lock = threading.Lock()
+
+  def _uncompress(self, response, chunk_size=64 * 1024):
+    """decompress a gzip'ed response while it is downloaded
+
+    Yields the lines (without newline) one at a time.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    while True:
+      chunk = decompressor.unconsumed_tail
+      if not chunk:
+        chunk = response.read(chunk_size)
+        if not chunk:
+          break
+      lines = (pending + decompressor.decompress(chunk, chunk_size)).split("\n")
+      pending = lines.pop()
+      for line in lines:
+        yield line
+    pending += decompressor.flush()
+    for line in pending.split("\n"):
+      if line:
+        yield line
 
-  def _get_and_uncompress(self, url):
+  def _cache_path(self, url):
+    return os.path.join(self.cache_directory, 'cpan-{0}.pickle'.format(hashlib.sha1(url).hexdigest()))
+
+  def _load_index(self, name, parse):
+    url = urlparse.urljoin(self.mirror, name)
     response = urlopen(url, timeout=TIMEOUT())
-    buf = StringIO.StringIO(response.read())
-    response.close()
-    return gzip.GzipFile(fileobj=buf, mode='rb')
+    try:
+      stamp = _index_stamp(url, response.info())
+      cache_path = None
+      if self.cache_directory is not None and stamp is not None:
+        cache_path = self._cache_path(url)
+        try:
+          with open(cache_path, 'rb') as fh:
+            cached = cPickle.load(fh)
+          if cached.get('format') == _CPANIndex.FORMAT and cached['stamp'] == stamp:
+            return cached['index']
+        except (IOError, EOFError, KeyError, cPickle.UnpicklingError):
+          pass
+      index = _CPANIndex(parse(self._uncompress(response)))
+    finally:
+      response.close()
+
+    if cache_path is not None:
+      tmp = cache_path + '.new'
+      with open(tmp, 'wb') as fh:
+        cPickle.dump(dict(format=_CPANIndex.FORMAT, stamp=stamp, index=index), fh, cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmp, cache_path)
+    return index
 
   def check(self, homepage, pattern, uversionmangle=lambda x: x, dversionmangle=lambda x: x):
     if _re_cpan_dist.search(homepage):
@@ -274,7 +685,7 @@ class CPAN(object):
       return None
 
     results = []
-    for candidate in target:
+    for candidate in target.candidates(pattern):
       match = pattern.match(candidate)
       if match:
         url = urlparse.urljoin(self.mirror, candidate)
@@ -289,54 +700,58 @@ class CPAN(object):
 
   @property
   def dists(self):
-    if self._dists is None:
-      dists = []
-      contents = self._get_and_uncompress(urlparse.urljoin(self.mirror,
-	      'modules/02packages.details.txt.gz'))
-      for line in contents:
-        fields = line.strip().split(None, 2)
-        if len(fields) >= 3:
-          dists.append(fields[2])
-      contents.close()
-      self._dists = dists
+    with self._lock:
+      if self._dists is None:
+        self._dists = self._load_index('modules/02packages.details.txt.gz', self._parse_dists)
     return self._dists
 
+  def _parse_dists(self, contents):
+    # 02packages lists a distribution once per module; group them by
+    # directory for _CPANIndex.
+    dists = {}
+    for line in contents:
+      fields = line.strip().split(None, 2)
+      if len(fields) >= 3:
+        directory, sep, name = fields[2].rpartition('/')
+        dists.setdefault(directory, set()).add(name)
+    for directory in sorted(dists):
+      for name in sorted(dists[directory]):
+        yield directory, name
+
   @property
   def files(self):
-    if self._files is None:
-      files = []
-
-      re_dir = re.compile('^(.*):$')
-      re_interesting = re.compile('authors/id|modules/by-module')
-      re_file = re.compile(r'\.tar\.(?:gz|bz2|xz)')
-
-      current = '' # current directory
-      interesting = False # are we interested in files in the current directory?
-      contents = self._get_and_uncompress(urlparse.urljoin(self.mirror,
-	      'indices/ls-lR.gz'))
-      for line in contents:
-        line = line.strip()
-        if line == '':
-          current = ''
-          interesting = False
-
-        match = re_dir.match(line)
-        if match:
-          current = match.group(1)
-          interesting = re_interesting.search(current)
-        if not interesting or not current:
-          continue
+    with self._lock:
+      if self._files is None:
+        self._files = self._load_index('indices/ls-lR.gz', self._parse_files)
+    return self._files
 
-        # -rw-rw-r--   1 jhi      cpan-adm    1129 Aug 10  1998 README
-        # lrwxrwxrwx   1 root     csc           24 Feb 25 03:20 CA-97.17.sperl -> ../../5.0/CA-97.17.sperl
-        fields = line.split()
-        if len(fields) < 9:
-          continue
+  def _parse_files(self, contents):
+    re_dir = re.compile('^(.*):$')
+    re_interesting = re.compile('authors/id|modules/by-module')
+    re_file = re.compile(r'\.tar\.(?:gz|bz2|xz)')
 
-        if not re_file.search(fields[8]):
-          continue
+    current = '' # current directory
+    interesting = False # are we interested in files in the current directory?
+    for line in contents:
+      line = line.strip()
+      if line == '':
+        current = ''
+        interesting = False
 
-        files.append("{0}/{1}".format(current, fields[8]))
-      contents.close()
-      self._files = files
-    return self._files
+      match = re_dir.match(line)
+      if match:
+        current = match.group(1)
+        interesting = re_interesting.search(current)
+      if not interesting or not current:
+        continue
+
+      # -rw-rw-r--   1 jhi      cpan-adm    1129 Aug 10  1998 README
+      # lrwxrwxrwx   1 root     csc           24 Feb 25 03:20 CA-97.17.sperl -> ../../5.0/CA-97.17.sperl
+      fields = line.split()
+      if len(fields) < 9:
+        continue
+
+      if not re_file.search(fields[8]):
+        continue
+
+      yield current, fields[8]
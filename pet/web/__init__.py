@@ -16,8 +16,11 @@
 from pyramid.config import Configurator
 from pyramid.events import subscriber, NewRequest
 
-from pet.models import Session
+from pet.models import Session, Config
 from pet.web.views import *
+import pet.cache
+
+import os.path
 
 @subscriber(NewRequest)
 def add_session_to_request(event):
@@ -31,6 +34,17 @@ def main(global_config=None, **settings):
   #})
 
   config = Configurator(settings=settings)
+
+  session = Session()
+  try:
+    cache_dir = settings.get('overview_cache_directory') or session.query(Config.value) \
+        .filter_by(key='overview_cache_directory').scalar()
+  finally:
+    session.close()
+  if cache_dir is not None:
+    cache_dir = os.path.expanduser(cache_dir)
+  memory_size = int(settings.get('overview_cache_size', 16))
+  config.registry.overview_cache = pet.cache.ResponseCache(cache_dir, memory_size=memory_size)
   config.include('pyramid_chameleon')
   config.add_static_view('static', 'pet.web:static')
 
@@ -19,16 +19,52 @@ from pet.models import *
 import debian.changelog
 
 from pyramid.view import view_config
+from pyramid.renderers import render
 from pyramid.response import Response
-from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest
+from pyramid.httpexceptions import HTTPNotFound, HTTPBadRequest, HTTPNotModified
 from pyramid.url import route_url
 from sqlalchemy.orm import exc
+import sqlalchemy.orm
 
+import gzip
 import re
 import os
+import StringIO
+import zlib
 
-@view_config(route_name='overview', renderer='pet.web:templates/overview.pt')
+def _gzip(data):
+  buf = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fh:
+    fh.write(data)
+  return buf.getvalue()
+
+def _accepts_gzip(accept_encoding):
+  """check if an Accept-Encoding header allows a gzipped response"""
+  qualities = {}
+  for coding in accept_encoding.split(','):
+    params = coding.split(';')
+    name = params[0].strip().lower()
+    q = 1.0
+    for param in params[1:]:
+      key, sep, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    if name:
+      qualities[name] = q
+  q = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0.0)))
+  return q > 0
+
+@view_config(route_name='overview')
 class Overview(object):
+  """overview of the packages of a team
+
+  The page only changes when an updater changes the data_generation
+  counter, so it is rendered once per generation and kept gzipped in
+  the registry's overview_cache (a `pet.cache.ResponseCache`).
+  """
   def __init__(self, request):
     self.request = request
     self.session = request.session
@@ -36,18 +72,46 @@ class Overview(object):
   def changelog_url(self, named_tree):
     return route_url('changelog', self.request, named_tree_id=named_tree.id)
   def __call__(self):
-    named_trees = self.session.query(NamedTree) \
-        .join(NamedTree.package).join(Package.repository) \
-        .join(Repository.team).filter(Team.name == self.team_name) \
-        .filter((NamedTree.type == 'branch') & (NamedTree.name == None))
-    suite_cond = "1=1"
-    bt_cond = "1=1"
+    # Only known teams get a cache entry.
+    self.team_id = self.session.query(Team.id).filter(Team.name == self.team_name).scalar()
+    if self.team_id is None:
+      raise HTTPNotFound()
+    generation = self.session.query(Config.value).filter_by(key='data_generation').scalar() or '0'
+    gzipped = _accepts_gzip(self.request.headers.get('Accept-Encoding', ''))
+    etag = "{0}{1}".format(generation, '-gzip' if gzipped else '')
+    if etag in self.request.if_none_match:
+      response = HTTPNotModified()
+    else:
+      cache = self.request.registry.overview_cache
+      body = cache.get(self.team_name, generation)
+      if body is None:
+        body = _gzip(render('pet.web:templates/overview.pt', self.values(), self.request).encode('utf-8'))
+        cache.put(self.team_name, generation, body)
+      response = Response(content_type='text/html', charset='utf-8')
+      if gzipped:
+        response.body = body
+        response.content_encoding = 'gzip'
+      else:
+        response.body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    response.etag = etag
+    response.vary = ('Accept-Encoding',)
+    response.cache_control = 'no-cache'
+    return response
+  def values(self):
+    statuses = self.session.query(PackageStatus) \
+        .filter(PackageStatus.team_id == self.team_id) \
+        .order_by(PackageStatus.name, PackageStatus.repository_id, PackageStatus.package_id) \
+        .options(sqlalchemy.orm.joinedload(PackageStatus.named_tree).joinedload(NamedTree.watch_result)) \
+        .options(sqlalchemy.orm.joinedload(PackageStatus.highest_tag))
 
-    classifier = Classifier(self.session, named_trees, suite_cond, bt_cond)
+    classified = {}
+    for p in statuses:
+      classified.setdefault(p.classification, []).append(p)
 
     return {
-      "classified": classifier.classify(),
-      "classes": classifier.classes()
+      "classified": classified,
+      "classes": Classifier.classes(),
+      "view": self,
     }
 
 @view_config(route_name='changelog', renderer='pet.web:templates/changelog.pt')